@@ -2,6 +2,7 @@ from setuptools import setup, find_packages
 
 
 dev_packages = ["jupyterlab", "mypy", "flake8"]
+onnx_packages = ["onnxruntime"]
 
 
 setup(
@@ -12,7 +13,8 @@ setup(
     install_requires=open("requirements.txt").readlines(),
     description="",
     extras_require={
-        'dev': dev_packages
+        'dev': dev_packages,
+        'onnx': onnx_packages
     },
     entry_points={"console_scripts": ["abd = abd_model.tools.__main__:main"]},
     long_description_content_type="text/markdown",
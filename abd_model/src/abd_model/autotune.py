@@ -0,0 +1,143 @@
+"""Batch size and loader workers autotuning, probed on a real model and dataset."""
+
+import os
+import math
+import time
+import threading
+
+import torch
+from torch.utils.data import DataLoader, Subset
+
+
+def rss():
+    """Return current process resident memory, in MB. Linux only, 0 elsewhere."""
+
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError):
+        return 0.0
+
+
+class RSSPeak:
+    def __init__(self, interval=0.005):
+        """Sample, in a background thread, the process resident memory peak growth, in MB, as a context manager."""
+
+        self.interval = interval
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+
+    def sample(self):
+        while not self.stop.wait(self.interval):
+            self.peak = max(self.peak, rss())
+
+    def __enter__(self):
+        self.baseline = self.peak = rss()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        self.thread.join()
+        self.peak = max(self.peak, rss())
+
+    @property
+    def growth(self):
+        return self.peak - self.baseline
+
+
+def probe(dataset, step, device, bs, workers, batches, loader_bs=None):
+    """Return step throughput, in tiles/s, and probe peak memory, in MB, on a few dataset batches. Or None, None if OOM.
+
+    On CPU, memory is the resident memory peak growth during the probe, as sampled by RSSPeak.
+    """
+
+    loader_bs = loader_bs if loader_bs else bs
+    subset = Subset(dataset, range(min(len(dataset), loader_bs * (batches + 1))))
+    loader = DataLoader(subset, batch_size=loader_bs, shuffle=False, num_workers=workers)
+
+    if device.type == "cuda":
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats(device)
+
+    start = time.monotonic()
+    tick = None
+    tiles = 0
+    try:
+        with RSSPeak() as rss_peak:
+            for batch in loader:
+                n = step(batch, bs)
+
+                if tick is None:  # first batch is a warm up
+                    torch.cuda.synchronize(device) if device.type == "cuda" else None
+                    tick = time.monotonic()
+                    warmup = n
+                    continue
+
+                tiles += n
+
+        torch.cuda.synchronize(device) if device.type == "cuda" else None
+
+    except RuntimeError as error:
+        if "out of memory" not in str(error):
+            raise
+        torch.cuda.empty_cache() if device.type == "cuda" else None
+        return None, None
+
+    if tiles:
+        throughput = tiles / max(time.monotonic() - tick, 1e-6)
+    else:  # not enough data to warm up first
+        throughput = warmup / max(tick - start, 1e-6)
+
+    if device.type == "cuda":
+        memory = torch.cuda.max_memory_allocated(device) / (1024 * 1024)
+    else:
+        memory = rss_peak.growth
+
+    return throughput, memory
+
+
+def autotune(dataset, step, device, max_bs, max_workers, log, batches=3, loader_bs=None):
+    """Probe increasing batch sizes, then loader workers, and return the fastest (bs, workers) configuration.
+
+    step(batch, bs) must process a loader batch, and return the number of tiles processed.
+    With loader_bs set, loader batch size is fixed, and bs is only provided to step (e.g mosaic windows).
+    """
+
+    def candidates(maximum):
+        maximum = max(1, maximum)
+        powers = [2 ** i for i in range(0, int(math.log2(maximum)) + 1)]
+        return powers if powers[-1] == maximum else powers + [maximum]
+
+    log.log("---")
+    log.log("Autotune, probing on {} batches:".format(batches))
+    log.log("".join(column.ljust(12) for column in ["bs", "workers", "tiles/s", "memory (MB)"]))
+
+    def log_probe(bs, workers, throughput, memory):
+        if throughput is None:
+            log.log("".join(str(v).ljust(12) for v in [bs, workers, "OOM", "-"]))
+        else:
+            log.log("".join(str(v).ljust(12) for v in [bs, workers, "{:.2f}".format(throughput), "{:.0f}".format(memory)]))
+
+    # Batch size, with all workers to not starve: keep increasing while throughput improves significantly
+    best_bs, best = 1, 0.0
+    max_bs = min(max_bs, max(1, math.floor(len(dataset) / 2))) if not loader_bs else max_bs
+    for bs in candidates(max_bs):
+        throughput, memory = probe(dataset, step, device, bs, max_workers, batches, loader_bs)
+        log_probe(bs, max_workers, throughput, memory)
+
+        if throughput is None or throughput < best * 1.05:
+            break
+        best_bs, best = bs, throughput
+
+    # Workers, with best batch size: the fewest ones, with a throughput close to the best one
+    throughputs = {max_workers: best}
+    for workers in candidates(max_workers)[:-1]:
+        throughput, memory = probe(dataset, step, device, best_bs, workers, batches, loader_bs)
+        log_probe(best_bs, workers, throughput, memory)
+        throughputs[workers] = throughput if throughput is not None else 0.0
+
+    best_workers = min([workers for workers, throughput in throughputs.items() if throughput >= 0.95 * best])
+
+    log.log("Autotune selected: --bs {} --workers {}".format(best_bs, best_workers))
+    return best_bs, best_workers
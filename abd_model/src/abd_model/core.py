@@ -1,5 +1,7 @@
 import os
 import sys
+import json
+import time
 import glob
 import toml
 from importlib import import_module
@@ -120,6 +122,73 @@ class Logs:
             print(msg, file=self.out)
 
 
+#
+# Timings
+#
+class Timer:
+    def __init__(self, path, **labels):
+        """Create a stages timer, appending its records, with labels (e.g rank), as JSON lines to a metrics file."""
+
+        self.labels = labels
+        self.fp = open(path, mode="a") if path else None
+        self.laps = {}
+        self.totals = {}
+        self.counters = {}
+        self.gauges = {}
+        self.start = self.tick = time.monotonic()
+
+    def lap(self, stage):
+        """Account the time elapsed since the previous lap, to a stage."""
+
+        now = time.monotonic()
+        self.laps[stage] = self.laps.get(stage, 0.0) + now - self.tick
+        self.tick = now
+
+    def record(self, counters=None, gauges=None):
+        """Append current laps, counters (e.g tiles) and gauges (e.g queue depth), as a record to the metrics file."""
+
+        counters = counters if counters else {}
+        gauges = gauges if gauges else {}
+
+        for stage, seconds in self.laps.items():
+            self.totals[stage] = self.totals.get(stage, 0.0) + seconds
+        for counter, value in counters.items():
+            self.counters[counter] = self.counters.get(counter, 0) + value
+        for gauge, value in gauges.items():
+            self.gauges[gauge] = max(self.gauges.get(gauge, value), value)
+
+        record = dict(time=round(time.monotonic() - self.start, 6), **self.labels)
+        record.update(self.round(self.laps))
+        record.update(counters)
+        record.update(gauges)
+        self.write(record)
+        self.laps = {}
+
+    def summary(self, **totals):
+        """Append, and return, a summary record: stages and extra totals, counters, max gauges, and elapsed time."""
+
+        elapsed = time.monotonic() - self.start
+        summary = dict(summary=True, elapsed=round(elapsed, 6), **self.labels, **self.round(dict(self.totals, **totals)))
+        summary.update(self.counters)
+        summary.update({"max_" + gauge: value for gauge, value in self.gauges.items()})
+        summary.update({"{}/s".format(k): round(v / elapsed, 3) if elapsed else 0.0 for k, v in self.counters.items()})
+        self.write(summary)
+
+        return summary
+
+    def round(self, stages):
+        return {stage: round(seconds, 6) for stage, seconds in stages.items()}
+
+    def write(self, record):
+        if self.fp:
+            self.fp.write(json.dumps(record) + os.linesep)
+            self.fp.flush()
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+
+
 #
 # Colors
 #
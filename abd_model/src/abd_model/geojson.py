@@ -1,3 +1,6 @@
+import collections
+
+import numpy as np
 from rasterio.crs import CRS
 from rasterio.warp import transform_geom
 from rasterio.features import rasterize
@@ -5,13 +8,15 @@ from rasterio.transform import from_bounds
 
 import mercantile
 from supermercado import burntiles
-from shapely.geometry import shape, mapping
+from shapely.geometry import shape, mapping, box, Polygon
+
+from abd_model.tiles import tile_bbox, TileIndex
 
-from abd_model.tiles import tile_bbox
 
+def geojson_parse_polygons(srid, feature, buffer=0):
+    """Return feature Polygons, as EPSG:4326 2D GeoJSON geometries, MultiPolygons and GeometryCollections being split."""
 
-def geojson_parse_feature(zoom, srid, feature_map, feature, buffer=0):
-    def geojson_parse_polygon(zoom, srid, feature_map, polygon):
+    def geojson_parse_polygon(srid, polygon):
 
         if isinstance(polygon["coordinates"], list):  # https://github.com/Toblerity/Shapely/issues/245
             for i, ring in enumerate(polygon["coordinates"]):  # GeoJSON coordinates could be N dimensionals
@@ -21,41 +26,159 @@ def geojson_parse_feature(zoom, srid, feature_map, feature, buffer=0):
             try:
                 polygon = transform_geom(CRS.from_epsg(srid), CRS.from_epsg(4326), polygon)
             except:  # negative buffer could lead to empty/invalid geom
-                return feature_map
+                return []
 
-        try:
-            for tile in burntiles.burn([{"type": "feature", "geometry": polygon}], zoom=zoom):
-                feature_map[mercantile.Tile(*tile)].append({"type": "feature", "geometry": polygon})
-        except:
-            pass
+        return [polygon] if polygon["coordinates"] and polygon["coordinates"][0] else []
 
-        return feature_map
-
-    def geojson_parse_geometry(zoom, srid, feature_map, geometry, buffer):
+    def geojson_parse_geometry(srid, geometry, buffer):
         if buffer:
             geometry = transform_geom(CRS.from_epsg(srid), CRS.from_epsg(3857), geometry)  # be sure to be planar
             geometry = mapping(shape(geometry).buffer(buffer))
             srid = 3857
 
         if geometry["type"] == "Polygon":
-            feature_map = geojson_parse_polygon(zoom, srid, feature_map, geometry)
+            return geojson_parse_polygon(srid, geometry)
 
-        elif geometry["type"] == "MultiPolygon":
-            for polygon in geometry["coordinates"]:
-                feature_map = geojson_parse_polygon(zoom, srid, feature_map, {"type": "Polygon", "coordinates": polygon})
+        if geometry["type"] == "MultiPolygon":
+            polygons = [{"type": "Polygon", "coordinates": polygon} for polygon in geometry["coordinates"]]
+            return [parsed for polygon in polygons for parsed in geojson_parse_polygon(srid, polygon)]
 
-        return feature_map
+        return []
 
     if not feature or not feature["geometry"]:
-        return feature_map
+        return []
 
     if feature["geometry"]["type"] == "GeometryCollection":
-        for geometry in feature["geometry"]["geometries"]:
-            feature_map = geojson_parse_geometry(zoom, srid, feature_map, geometry, buffer)
-    else:
-        feature_map = geojson_parse_geometry(zoom, srid, feature_map, feature["geometry"], buffer)
+        geometries = feature["geometry"]["geometries"]
+        return [polygon for geometry in geometries for polygon in geojson_parse_geometry(srid, geometry, buffer)]
+
+    return geojson_parse_geometry(srid, feature["geometry"], buffer)
+
+
+def geojson_polygon_tiles(zoom, polygon):
+    """Return the tiles, at zoom, an EPSG:4326 GeoJSON Polygon burns."""
+
+    try:
+        return [mercantile.Tile(*tile) for tile in burntiles.burn([{"type": "feature", "geometry": polygon}], zoom=zoom)]
+    except:
+        return []
+
+
+def geojson_polygons_arrays(polygons):
+    """Return EPSG:4326 GeoJSON Polygons as compact arrays: EPSG:3857 coordinates, rings lengths, and polygons rings."""
+
+    rings = [np.asarray(ring, dtype=np.float64).reshape(-1, 2) for polygon in polygons for ring in polygon["coordinates"]]
+    coords = np.concatenate(rings) if rings else np.zeros((0, 2), dtype=np.float64)
+
+    R = 6378137.0  # vectorized EPSG:4326 to EPSG:3857, once for all coordinates
+    lon, lat = np.radians(coords[:, 0]), np.radians(np.clip(coords[:, 1], -85.0511287798, 85.0511287798))
+    coords = np.stack([R * lon, R * np.log(np.tan(np.pi / 4 + lat / 2))], axis=1)
+
+    rings_lengths = np.array([len(ring) for ring in rings], dtype=np.int64)
+    polygons_rings = np.array([len(polygon["coordinates"]) for polygon in polygons], dtype=np.int64)
+
+    return coords, rings_lengths, polygons_rings
+
+
+class FeaturesIndex:
+    def __init__(self, zoom, coords, rings, polygons, cache=65536):
+        """Quadkey bucketed spatial index, on polygons stored once, as EPSG:3857 coords arrays, and referenced by position.
+
+        Each polygon is bucketed in the (up to 2x2) tiles covering its bounds, on the deepest level, up to zoom, they fit in.
+        Shapely polygons, built on exact intersection tests, are kept in a least recently used cache, up to cache ones.
+        """
+
+        self.zoom = zoom
+        self.coords = coords  # N,2 EPSG:3857 coordinates, of every ring
+        self.rings = np.concatenate([[0], np.cumsum(rings)]).astype(np.int64)  # ring i: coords[rings[i] : rings[i + 1]]
+        self.polygons = np.concatenate([[0], np.cumsum(polygons)]).astype(np.int64)  # polygon j rings offsets
+
+        starts = self.rings[self.polygons[:-1]]  # each polygon rings are contiguous
+        self.bounds = np.zeros((len(starts), 4), dtype=np.float64)
+        if len(starts):
+            for i, (ufunc, axis) in enumerate([(np.minimum, 0), (np.minimum, 1), (np.maximum, 0), (np.maximum, 1)]):
+                self.bounds[:, i] = ufunc.reduceat(coords[:, axis], starts)
+
+        def mercator_to_xy(X, Y):
+            half, size = 20037508.342789244, 1 << zoom
+            x, y = np.floor((X + half) / (2 * half) * size), np.floor((half - Y) / (2 * half) * size)
+            return np.clip(x, 0, size - 1).astype(np.int64), np.clip(y, 0, size - 1).astype(np.int64)
+
+        x0, y0 = mercator_to_xy(self.bounds[:, 0], self.bounds[:, 3])  # upper left
+        x1, y1 = mercator_to_xy(self.bounds[:, 2], self.bounds[:, 1])  # lower right
+
+        shift = np.zeros(len(self.bounds), dtype=np.int64)  # zoom - bucket level
+        while len(shift):
+            wide = ((x1 >> shift) - (x0 >> shift) > 1) | ((y1 >> shift) - (y0 >> shift) > 1)
+            if not wide.any():
+                break
+            shift += wide
+
+        keys, positions = [], []
+        for dx, dy in [(0, 0), (1, 0), (0, 1), (1, 1)]:
+            x, y = (x0 >> shift) + dx, (y0 >> shift) + dy
+            keep = (x <= x1 >> shift) & (y <= y1 >> shift)
+            keys.append(TileIndex.encode(x[keep], y[keep], zoom - shift[keep]))
+            positions.append(np.flatnonzero(keep))
+
+        keys, positions = np.concatenate(keys), np.concatenate(positions)
+        order = np.argsort(keys, kind="stable")
+        self.keys, self.positions = keys[order], positions[order]
+        self.shifts = np.unique(shift)
+        self.shapes = collections.OrderedDict()  # least recently used bounded, per process, Shapely polygons
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.bounds)
+
+    def polygon(self, i):
+        """Return polygon i rings, as EPSG:3857 coords arrays views."""
+
+        rings = range(self.polygons[i], self.polygons[i + 1])
+        return [self.coords[self.rings[ring] : self.rings[ring + 1]] for ring in rings]
+
+    def intersects(self, i, tile_box):
+        if i not in self.shapes:
+            if len(self.shapes) >= self.cache:
+                self.shapes.popitem(last=False)
+            rings = self.polygon(i)
+            self.shapes[i] = Polygon(rings[0], rings[1:])
+        self.shapes.move_to_end(i)
+
+        try:
+            return self.shapes[i].intersects(tile_box)
+        except Exception:  # invalid geometry: kept, as bounds intersect
+            return True
+
+    def query(self, tile):
+        """Return, in input order, positions of the polygons intersecting the tile, as burntiles would have burned it.
+
+        Bounds buckets and bounds are only a prefilter, polygons bounds not within the tile being then tested exactly.
+        """
+
+        assert tile.z == self.zoom, "FeaturesIndex is built for zoom {} tiles".format(self.zoom)
+
+        keys = TileIndex.encode(np.int64(tile.x) >> self.shifts, np.int64(tile.y) >> self.shifts, tile.z - self.shifts)
+        lo, hi = np.searchsorted(self.keys, keys, side="left"), np.searchsorted(self.keys, keys, side="right")
+        buckets = [self.positions[start:end] for start, end in zip(lo, hi)]
+        positions = np.sort(np.concatenate(buckets + [np.zeros(0, np.int64)]))
+
+        w, s, e, n = mercantile.xy_bounds(tile)
+        bounds = self.bounds[positions]
+        positions = positions[(bounds[:, 0] <= e) & (bounds[:, 2] >= w) & (bounds[:, 1] <= n) & (bounds[:, 3] >= s)]
+
+        bounds = self.bounds[positions]
+        within = (bounds[:, 0] >= w) & (bounds[:, 2] <= e) & (bounds[:, 1] >= s) & (bounds[:, 3] <= n)
+        tile_box = box(w, s, e, n)
+        exact = [keep or self.intersects(i, tile_box) for i, keep in zip(positions.tolist(), within.tolist())]
+
+        return positions[np.array(exact, dtype=bool)]
+
+    def features(self, tile):
+        """Return, as EPSG:3857 GeoJSON features with coords arrays views, the ones intersecting the tile."""
 
-    return feature_map
+        polygons = [{"type": "Polygon", "coordinates": self.polygon(i)} for i in self.query(tile)]
+        return [{"type": "feature", "geometry": polygon} for polygon in polygons]
 
 
 def geojson_srid(feature_collection):
@@ -74,9 +197,11 @@ def geojson_tile_burn(tile, features, srid, ts, burn_value=1):
     """Burn tile with GeoJSON features."""
 
     crs = (CRS.from_epsg(srid), CRS.from_epsg(3857))
-    shapes = ((transform_geom(*crs, feature["geometry"]), burn_value) for feature in features)
+    geometries = (feature["geometry"] if srid == 3857 else transform_geom(*crs, feature["geometry"]) for feature in features)
+    shapes = ((geometry, burn_value) for geometry in geometries)
 
     try:
-        return rasterize(shapes, out_shape=ts, transform=from_bounds(*tile_bbox(tile, mercator=True), *ts))
+        transform = from_bounds(*tile_bbox(tile, mercator=True), *ts)
+        return rasterize(shapes, out_shape=ts, transform=transform, dtype=np.uint8)  # else int64, on newer rasterio
     except:
         return None
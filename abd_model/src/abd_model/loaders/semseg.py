@@ -1,35 +1,70 @@
 """PyTorch-compatible datasets. Cf: https://pytorch.org/docs/stable/data.html """
 
 import os
+import sys
+import json
+import hashlib
 import numpy as np
+import mercantile
 import torch.utils.data
 
 from abd_model.da.core import to_tensor
-from abd_model.tiles import tiles_from_dir, tile_image_from_file, tile_label_from_file, tile_image_buffer, tile_is_neighboured
+from abd_model.tiles import (
+    tiles_from_dir,
+    tile_image_from_file,
+    tile_label_from_file,
+    tile_image_buffer,
+    tile_image_mosaic,
+    tile_strip_key,
+    TilesCache,
+    TileIndex,
+)
 
 
 class SemSeg(torch.utils.data.Dataset):
-    def __init__(self, config, ts, root, cover=None, tiles_weights=None, mode=None, metatiles=False, keep_borders=False):
+    def __init__(
+        self,
+        config,
+        ts,
+        root,
+        cover=None,
+        tiles_weights=None,
+        mode=None,
+        metatiles=False,
+        keep_borders=False,
+        mosaic=None,
+        mosaic_border=0,
+        skip=None,
+        cache_size=0,
+    ):
         super().__init__()
 
         self.mode = mode
         self.config = config
         self.tiles_weights = tiles_weights
         self.metatiles = metatiles
+        self.mosaic = mosaic
+        self.mosaic_border = mosaic_border
+        self.cache = TilesCache(cache_size) if (metatiles or mosaic) and cache_size else None
         self.da = True if "da" in self.config["train"].keys() and self.config["train"]["da"]["p"] > 0.0 else False
 
         assert mode in ["train", "eval", "predict"]
+        assert not (mosaic and mode != "predict"), "Mosaic is only available in predict mode"
 
         path = os.path.join(root, config["channels"][0]["name"])
-        self.tiles_paths = [(tile, path) for tile, path in tiles_from_dir(path, cover=cover, xyz_path=True)]
-        if metatiles:
-            self.metatiles_paths = self.tiles_paths
+        index = TileIndex(tiles_from_dir(path, cover=cover, xyz_path=True))
+        if metatiles or mosaic:  # each channel, with all its tiles, to be used as neighbours
+            self.metatiles_paths = {config["channels"][0]["name"]: index}
+            for channel in config["channels"][1:]:
+                path = os.path.join(root, channel["name"])
+                self.metatiles_paths[channel["name"]] = TileIndex(tiles_from_dir(path, cover=cover, xyz_path=True))
             if not keep_borders:
-                self.tiles_paths = [
-                    (tile, path) for tile, path in self.metatiles_paths if tile_is_neighboured(tile, self.metatiles_paths)
-                ]
-        self.cover = {tile for tile, path in self.tiles_paths}
-        assert len(self.tiles_paths), "Empty Dataset"
+                index = index.select(index.neighboured())
+        if skip:  # still available as metatiles neighbours
+            index = index.select(~TileIndex(skip).contains(index.x, index.y, index.z))
+        self.tiles_paths = list(index.items())
+        self.cover = index
+        assert len(self.tiles_paths) or skip, "Empty Dataset"
 
         self.tiles = {}
         num_channels = 0
@@ -46,21 +81,48 @@ class SemSeg(torch.utils.data.Dataset):
         if self.mode in ["train", "eval"]:
             path = os.path.join(root, "labels")
             self.tiles["labels"] = [(tile, path) for tile, path in tiles_from_dir(path, cover=self.cover, xyz_path=True)]
+            self.tiles["labels"].sort(key=lambda tile: tile_strip_key(tile[0]))
 
-            for channel in config["channels"]:  # Order images and labels accordingly
-                self.tiles[channel["name"]].sort(key=lambda tile: tile[0])
-            self.tiles["labels"].sort(key=lambda tile: tile[0])
+        for channel in config["channels"]:  # Order images and labels accordingly, neighbours close to each others
+            self.tiles[channel["name"]].sort(key=lambda tile: tile_strip_key(tile[0]))
+
+        if mosaic:  # K x K tiles blocks, each one indexed by its upper-left tile
+            blocks = {mercantile.Tile(tile.x // mosaic, tile.y // mosaic, tile.z) for tile in self.cover}
+            self.mosaics = [
+                mercantile.Tile(block.x * mosaic, block.y * mosaic, block.z) for block in sorted(blocks, key=tile_strip_key)
+            ]
+
+        self.predecoded = None  # abd dataset --mode cache, if any and up to date
+        predecoded = os.path.join(os.path.expanduser(root), "cache")
+        if self.mode in ["train", "eval"] and not metatiles and os.path.isfile(os.path.join(predecoded, "index.json")):
+            with open(os.path.join(predecoded, "index.json")) as fp:
+                key = json.load(fp)["key"]
+
+            if key == cache_key(config, self.cover):
+                tiles = [tile for tile, _ in self.tiles[config["channels"][0]["name"]]]
+                self.predecoded = predecoded
+                self.predecoded_rows = self.cover.lookup([t.x for t in tiles], [t.y for t in tiles], [t.z for t in tiles])
+                self.predecoded_arrays = None  # lazily memory mapped, once per loader worker
+            else:
+                print("WARNING: outdated dataset cache, ignored. Run abd dataset --mode cache again", file=sys.stderr)
 
         assert len(self.tiles), "Empty Dataset"
 
     def __len__(self):
-        return len(self.tiles_paths)
+        return len(self.mosaics) if self.mosaic else len(self.tiles_paths)
 
     def __getitem__(self, i):
 
+        if self.mosaic:
+            return self.getitem_mosaic(i)
+
+        if self.predecoded:
+            return self.getitem_predecoded(i)
+
         tile = None
         mask = None
         image = None
+        c = 0
 
         for channel in self.config["channels"]:
 
@@ -69,13 +131,15 @@ class SemSeg(torch.utils.data.Dataset):
             bands = None if not channel["bands"] else channel["bands"]
 
             if self.metatiles:
-                image_channel = tile_image_buffer(tile, self.metatiles_paths, bands)
+                image_channel = tile_image_buffer(tile, self.metatiles_paths[channel["name"]], bands, self.cache)
             else:
-                image_channel = tile_image_from_file(path, bands)
+                out = image[:, :, c : c + len(bands)] if image is not None and bands else None
+                image_channel = tile_image_from_file(path, bands, out=out)
 
             assert image_channel is not None, "Dataset channel {} not retrieved: {}".format(channel["name"], path)
 
-            image = np.concatenate((image, image_channel), axis=2) if image is not None else image_channel
+            image = stack_channel(image, image_channel, c, self.shape_in[0])
+            c += image_channel.shape[2]
 
         if self.mode in ["train", "eval"]:
             assert tile == self.tiles["labels"][i][0], "Dataset mask inconsistency"
@@ -91,3 +155,89 @@ class SemSeg(torch.utils.data.Dataset):
         if self.mode in ["predict"]:
             image = to_tensor(self.config, self.shape_in[1:3], image, resize=False, da=False)
             return image, torch.IntTensor([tile.x, tile.y, tile.z])
+
+    def getitem_predecoded(self, i):
+
+        if self.predecoded_arrays is None:  # copy on write: zero-copy slices, even if data augmentation writes in
+            paths = [os.path.join(self.predecoded, name) for name in ["images.npy", "labels.npy"]]
+            self.predecoded_arrays = [np.load(path, mmap_mode="c") for path in paths]
+
+        images, labels = self.predecoded_arrays
+        row = self.predecoded_rows[i]
+        tile = self.tiles[self.config["channels"][0]["name"]][i][0]
+        weight = self.tiles_weights[tile] if self.tiles_weights is not None and tile in self.tiles_weights else 1.0
+
+        image, mask = to_tensor(self.config, self.shape_in[1:3], images[row], mask=labels[row], da=self.da)
+        return image, mask, tile, weight
+
+    def getitem_mosaic(self, i):
+
+        image = None
+        tile = self.mosaics[i]
+        ts = self.shape_in[1]
+        c = 0
+
+        for channel in self.config["channels"]:
+            bands = None if not channel["bands"] else channel["bands"]
+            tiles = self.metatiles_paths[channel["name"]]
+            image_channel = tile_image_mosaic(tile, self.mosaic, ts, self.mosaic_border, tiles, bands, self.cache)
+            image = stack_channel(image, image_channel, c, self.shape_in[0])
+            c += image_channel.shape[2]
+
+        image = to_tensor(self.config, self.shape_in[1:3], image, resize=False, da=False)
+        return image, torch.IntTensor([tile.x, tile.y, tile.z])
+
+
+def stack_channel(image, image_channel, c, C):
+    """Stack a H,W,C channel image at c offset, in a H,W,C image buffer, allocated on first channel. Return the buffer.
+
+    The buffer is upcast, if a later channel dtype doesn't fit in, so channels values are never wrapped.
+    """
+
+    if image is None and image_channel.shape[2] == C:  # single channel, nothing to stack
+        return image_channel
+
+    if image is None:
+        image = np.empty(image_channel.shape[0:2] + (C,), dtype=image_channel.dtype)
+    elif not np.can_cast(image_channel.dtype, image.dtype):  # upcast to np.result_type, as channels concatenate did
+        image = image.astype(np.result_type(image, image_channel))
+
+    if not np.may_share_memory(image, image_channel):  # unless already decoded in place
+        image[:, :, c : c + image_channel.shape[2]] = image_channel
+
+    return image
+
+
+def cache_key(config, tiles):
+    """Return a dataset cache key, changing if either cover tiles (as a TileIndex), or config channels, change."""
+
+    key = hashlib.sha1(json.dumps([[channel["name"], channel["bands"]] for channel in config["channels"]]).encode())
+    key.update(tiles.keys.tobytes())
+
+    return key.hexdigest()
+
+
+class LocalitySampler(torch.utils.data.Sampler):
+    def __init__(self, dataset, num_replicas=1, rank=0, bs=1, workers=0):
+        """Batch sampler, preserving dataset order locality: each replica, then each loader worker, gets contiguous batches.
+
+        As DataLoader dispatches batches to its workers round robin, contiguous chunks are interleaved accordingly.
+        Unlike DistributedSampler, no sample is duplicated to even out replicas: shards sizes differ by one at most,
+        and replicas only get an empty shard if there's less samples than replicas.
+        """
+
+        n, extra = divmod(len(dataset), num_replicas)
+        start = rank * n + min(rank, extra)
+        indices = list(range(start, start + n + (1 if rank < extra else 0)))
+        batches = [indices[i : i + bs] for i in range(0, len(indices), bs)]
+
+        W = max(1, workers)
+        sizes = [len(batches) // W + (1 if w < len(batches) % W else 0) for w in range(W)]  # largest chunks first
+        offsets = [sum(sizes[:w]) for w in range(W)]
+        self.batches = [batches[offsets[w] + i] for i in range(max(sizes)) for w in range(W) if i < sizes[w]]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
@@ -6,7 +6,13 @@ import io
 import os
 import re
 import glob
+import time
+import atexit
+import sqlite3
+import collections
 import warnings
+import threading
+import concurrent.futures as futures
 
 import numpy as np
 from PIL import Image
@@ -62,24 +68,278 @@ def tiles_from_csv(path, xyz=True, extra_columns=False):
                     yield [row[0], *map(float, row[1:])]
 
 
+def tiles_from_manifest(path, empty=False):
+    """Retrieve tiles from an abd predict manifest, by default only the ones with at least a non background pixel."""
+
+    for row in tiles_from_csv(path, extra_columns=True):
+        tile, pixels = (row[0], row[1]) if isinstance(row, list) else (row, None)
+
+        if empty or pixels is None or pixels > 0:
+            yield tile
+
+
+MBTILES = "mbtiles://"
+
+
+class MBTiles:
+    def __init__(self, path, batch=256):
+        """Packed tiles store, in a single MBTiles like SQLite file, keyed by z/x/y. Writes are batched in transactions.
+
+        SQLite connections are not to be shared between processes: use tiles_store() to retrieve one.
+        """
+
+        self.path = os.path.expanduser(path)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        self.batch = batch
+        self.pending = {}
+        self.callbacks = []
+        self.format = None
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(self.path, timeout=600, check_same_thread=False)
+
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")  # concurrent readers, alongside a writer
+            self.db.execute("CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,"
+                " tile_data BLOB, PRIMARY KEY (zoom_level, tile_column, tile_row))"
+            )
+            self.db.commit()
+
+    @staticmethod
+    def key(tile):
+        """MBTiles rows are TMS ones: y axis is flipped."""
+
+        return int(tile.z), int(tile.x), (1 << int(tile.z)) - 1 - int(tile.y)
+
+    def put(self, tile, data, ext):
+        """Queue an encoded tile write, committed with the next batch."""
+
+        with self.lock:
+            self.pending[self.key(tile)] = data
+            self.format = ext
+            if len(self.pending) >= self.batch:
+                self.flush()
+
+    def committed(self, callback):
+        """Call back, once every write already queued is committed (e.g to keep a manifest crash safe)."""
+
+        with self.lock:
+            self.callbacks.append(callback)
+            if not self.pending:
+                self.flush()
+
+    def get(self, tile):
+        """Return an encoded tile, or None if not in store."""
+
+        key = self.key(tile)
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+
+            query = "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?"
+            row = self.db.execute(query, key).fetchone()
+
+        return bytes(row[0]) if row else None
+
+    def tiles(self):
+        """Yield every tile in store."""
+
+        with self.lock:
+            self.flush()
+            rows = self.db.execute("SELECT zoom_level, tile_column, tile_row FROM tiles").fetchall()
+
+        for z, x, row in rows:
+            yield mercantile.Tile(x, (1 << z) - 1 - row, z)
+
+    def flush(self):
+        """Commit pending writes, in a single transaction."""
+
+        with self.lock:
+            if self.pending:
+                with self.db:
+                    rows = [(z, x, row, sqlite3.Binary(data)) for (z, x, row), data in self.pending.items()]
+                    self.db.executemany("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)", rows)
+                    self.db.execute("INSERT OR REPLACE INTO metadata VALUES ('format', ?)", (self.format,))
+                self.pending = {}
+
+            callbacks, self.callbacks = self.callbacks, []
+            for callback in callbacks:
+                callback()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+            self.db.close()
+
+
+tiles_stores = {}
+tiles_stores_lock = threading.Lock()
+
+
+def tiles_store(uri):
+    """Return the packed store, opened once per process, from a mbtiles:// URI (optionally with #z/x/y), or None."""
+
+    if not isinstance(uri, str) or not uri.startswith(MBTILES):
+        return None
+
+    key = (os.getpid(), os.path.abspath(os.path.expanduser(uri[len(MBTILES) :].partition("#")[0])))
+    with tiles_stores_lock:
+        if key not in tiles_stores:
+            tiles_stores[key] = MBTiles(key[1])
+
+        return tiles_stores[key]
+
+
+def tiles_store_path(root, tile):
+    """Return a packed store tile URI: mbtiles://path#z/x/y"""
+
+    return "{}#{}/{}/{}".format(root.partition("#")[0], tile.z, tile.x, tile.y)
+
+
+def tiles_store_tile(uri):
+    """Return the tile, from a packed store tile URI."""
+
+    z, x, y = map(int, uri.partition("#")[2].split("/"))
+    return mercantile.Tile(x, y, z)
+
+
+@atexit.register
+def tiles_stores_close():
+    """Commit and close every packed store opened by this process. Processes ended by os._exit have to call it."""
+
+    with tiles_stores_lock:
+        for pid, path in [key for key in tiles_stores.keys() if key[0] == os.getpid()]:
+            tiles_stores.pop((pid, path)).close()
+
+
+def tiles_side_path(root, name):
+    """Return a tiles root side output path (e.g log): either in itself, or alongside a packed store, named after it."""
+
+    if tiles_store(root) is None:
+        return os.path.join(os.path.expanduser(root), name)
+
+    path = os.path.abspath(os.path.expanduser(root[len(MBTILES) :].partition("#")[0]))
+    return "{}.{}".format(os.path.splitext(path)[0], name)  # e.g a.mbtiles -> a.log, not shared with b.mbtiles
+
+
+def tile_source(path):
+    """Return a readable source, from a tile path or a packed store tile URI, and its format extension."""
+
+    store = tiles_store(path)
+    if store is None:
+        return os.path.expanduser(path), os.path.splitext(path)[1][1:]
+
+    data = store.get(tiles_store_tile(path))
+    assert data is not None, "Unable to read {}".format(path)
+    magics = {b"\x89PNG": "png", b"RIFF": "webp", b"\xff\xd8\xff": "jpeg", b"II*\x00": "tiff", b"MM\x00*": "tiff"}
+    ext = [ext for magic, ext in magics.items() if data.startswith(magic)]
+
+    return io.BytesIO(data), ext[0] if ext else None
+
+
+TILES_INDEX = ".tiles_index.npz"
+
+
+def tiles_scan(root, workers=None, persist=True):
+    """Scan a slippy map dir, in parallel, returning its tiles as a N,3 int64 x,y,z array, and their files extensions.
+
+    Scan results are persisted in a root index file. Next scans only list again z/x dirs with a modified mtime.
+    """
+
+    root = os.path.expanduser(root)
+    index_path = os.path.join(root, TILES_INDEX)
+
+    def digits(path):
+        try:
+            with os.scandir(path) as entries:
+                return [(int(entry.name), entry.path) for entry in entries if entry.name.isdigit() and entry.is_dir()]
+        except OSError:
+            return []
+
+    dirs = [(z, x, path) for z, z_path in digits(root) for x, path in digits(z_path)]
+
+    previous = {}  # (z, x) -> (mtime, ys, exts), from index file
+    if persist and os.path.isfile(index_path):
+        try:
+            with np.load(index_path, allow_pickle=False) as index:
+                offsets = np.cumsum(index["counts"])[:-1]
+                ys, exts = np.split(index["ys"], offsets), np.split(index["exts"], offsets)
+                for i, (z, x) in enumerate(index["dirs"].tolist()):
+                    previous[(z, x)] = (int(index["mtimes"][i]), ys[i], exts[i])
+        except Exception:
+            previous = {}  # unreadable or outdated index format, scan it all again
+
+    def scan(z_x_path):
+        z, x, path = z_x_path
+        mtime = os.stat(path).st_mtime_ns
+        if (z, x) in previous and previous[(z, x)][0] == mtime:
+            return mtime, previous[(z, x)][1], previous[(z, x)][2], False
+
+        ys, exts = [], []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                y, dot, ext = entry.name.partition(".")
+                if dot and ext and y.isdigit():
+                    ys.append(int(y))
+                    exts.append(ext)
+
+        return mtime, np.array(ys, dtype=np.int64), np.array(exts, dtype=np.str_), True
+
+    with futures.ThreadPoolExecutor(workers if workers else os.cpu_count()) as executor:
+        scans = list(executor.map(scan, sorted(dirs)))
+
+    counts = np.array([len(ys) for _, ys, _, _ in scans], dtype=np.int64)
+    ys = np.concatenate([ys for _, ys, _, _ in scans]) if scans else np.zeros(0, dtype=np.int64)
+    exts = np.concatenate([exts.astype(np.str_) for _, _, exts, _ in scans]) if scans else np.zeros(0, dtype=np.str_)
+    zx = np.array([(z, x) for z, x, _ in sorted(dirs)], dtype=np.int64).reshape(-1, 2)
+    xyz = np.stack([np.repeat(zx[:, 1], counts), ys, np.repeat(zx[:, 0], counts)], axis=1)
+
+    if persist and (any(rescanned for _, _, _, rescanned in scans) or len(previous) != len(dirs)):
+        now = time.time_ns()
+        mtimes = [mtime if now - mtime > 2e9 else -1 for mtime, _, _, _ in scans]  # too recent, to be trusted
+        try:
+            tmp = "{}.{}".format(index_path, os.getpid())
+            with open(tmp, "wb") as fp:
+                np.savez(fp, dirs=zx, mtimes=np.array(mtimes, dtype=np.int64), counts=counts, ys=ys, exts=exts)
+            os.replace(tmp, index_path)
+        except OSError:
+            pass  # e.g read only dir: just not persisted
+
+    return xyz, exts
+
+
 def tiles_from_dir(root, cover=None, xyz=True, xyz_path=False):
-    """Loads files from an on-disk dir."""
+    """Loads files from an on-disk dir, or from a mbtiles:// packed store."""
+    cover = set(cover) if cover is not None and not isinstance(cover, (set, frozenset, TileIndex)) else cover
+
+    store = tiles_store(root)
+    if store is not None:
+        for tile in store.tiles():
+            if cover is not None and tile not in cover:
+                continue
+
+            yield (tile, tiles_store_path(root, tile)) if xyz_path else tile
+        return
+
     root = os.path.expanduser(root)
 
     if xyz is True:
-        paths = glob.glob(os.path.join(root, "[0-9]*/[0-9]*/[0-9]*.*"))
+        tiles, exts = tiles_scan(root)
+        if isinstance(cover, TileIndex):  # vectorized filtering
+            keep = cover.contains(tiles[:, 0], tiles[:, 1], tiles[:, 2])
+            tiles, exts, cover = tiles[keep], exts[keep], None
 
-        for path in paths:
-            tile_xyz = re.match(os.path.join(root, "(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+).+"), path)
-            if not tile_xyz:
-                continue
-            tile = mercantile.Tile(int(tile_xyz["x"]), int(tile_xyz["y"]), int(tile_xyz["z"]))
+        for (x, y, z), ext in zip(tiles.tolist(), exts.tolist()):
+            tile = mercantile.Tile(x, y, z)
 
             if cover is not None and tile not in cover:
                 continue
 
             if xyz_path is True:
-                yield tile, path
+                yield tile, os.path.join(root, str(z), str(x), "{}.{}".format(y, ext))
             else:
                 yield tile
 
@@ -91,7 +351,12 @@ def tiles_from_dir(root, cover=None, xyz=True, xyz_path=False):
 
 
 def tile_from_xyz(root, x, y, z):
-    """Retrieve a single tile from a slippy map dir."""
+    """Retrieve a single tile from a slippy map dir, or from a mbtiles:// packed store."""
+
+    store = tiles_store(root)
+    if store is not None:
+        tile = mercantile.Tile(int(x), int(y), int(z))
+        return (tile, tiles_store_path(root, tile)) if store.get(tile) is not None else None
 
     path = glob.glob(os.path.join(os.path.expanduser(root), str(z), str(x), str(y) + ".*"))
     if not path:
@@ -102,6 +367,94 @@ def tile_from_xyz(root, x, y, z):
     return mercantile.Tile(x, y, z), path[0]
 
 
+class TileIndex:
+    def __init__(self, tiles, paths=None):
+        """Array-backed tiles index, sorted on z, x, y, with vectorized lookups, neighbours masks, and paths.
+
+        tiles could be either tiles, or (tile, path) tuples, as yielded by tiles_from_dir with xyz_path.
+        Duplicate tiles are indexed once.
+        """
+
+        tiles = list(tiles)
+        if paths is None and tiles and len(tiles[0]) == 2:
+            tiles, paths = [tile for tile, _ in tiles], [path for _, path in tiles]
+
+        xyz = np.array([(int(tile[0]), int(tile[1]), int(tile[2])) for tile in tiles], dtype=np.int64).reshape(-1, 3)
+        keys = self.encode(xyz[:, 0], xyz[:, 1], xyz[:, 2])
+        self.keys, first = np.unique(keys, return_index=True)  # sorted
+
+        self.x, self.y, self.z = xyz[first, 0], xyz[first, 1], xyz[first, 2]
+        self.paths = [paths[i] for i in first] if paths is not None else None
+
+    @staticmethod
+    def encode(x, y, z):
+        """Hash tiles coordinates, up to zoom 29, to int64 keys, ordered on z, x, y."""
+
+        return (np.asarray(z, dtype=np.int64) << 58) | (np.asarray(x, dtype=np.int64) << 29) | np.asarray(y, dtype=np.int64)
+
+    def lookup(self, x, y, z):
+        """Vectorized lookup, returning tiles positions in the index, or -1 if not in."""
+
+        x, y, z = np.broadcast_arrays(*[np.asarray(v, dtype=np.int64) for v in (x, y, z)])
+        if not len(self.keys):
+            return np.full(x.shape, -1, dtype=np.int64)
+
+        size = np.left_shift(1, z)
+        valid = (x >= 0) & (y >= 0) & (x < size) & (y < size)
+        keys = self.encode(np.where(valid, x, 0), np.where(valid, y, 0), z)
+
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(valid & (self.keys[positions] == keys), positions, -1)
+
+    def contains(self, x, y, z):
+        """Vectorized membership, returning a boolean mask."""
+
+        return self.lookup(x, y, z) >= 0
+
+    def neighboured(self):
+        """Return a boolean mask, of index tiles surrounded by others index tiles."""
+
+        mask = np.ones(len(self), dtype=bool)
+        for dx, dy in [(dx, dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dx or dy]:
+            mask &= self.contains(self.x + dx, self.y + dy, self.z)
+
+        return mask
+
+    def path(self, tile, dx=0, dy=0):
+        """Return a tile path, or its dx, dy neighbour one, or None if not in the index."""
+
+        i = int(self.lookup(int(tile.x) + dx, int(tile.y) + dy, int(tile.z)))
+        return self.paths[i] if i >= 0 and self.paths is not None else None
+
+    def select(self, mask):
+        """Return a new index, restricted to the tiles selected by a boolean mask."""
+
+        index = TileIndex.__new__(TileIndex)
+        index.keys, index.x, index.y, index.z = self.keys[mask], self.x[mask], self.y[mask], self.z[mask]
+        index.paths = [path for path, keep in zip(self.paths, mask) if keep] if self.paths is not None else None
+
+        return index
+
+    def items(self):
+        """Yield (tile, path) tuples, in index order."""
+
+        for tile, path in zip(self, self.paths if self.paths is not None else [None] * len(self)):
+            yield tile, path
+
+    def __contains__(self, tile):
+        return bool(self.contains(tile.x, tile.y, tile.z))
+
+    def __eq__(self, other):
+        return isinstance(other, TileIndex) and np.array_equal(self.keys, other.keys)
+
+    def __iter__(self):
+        for x, y, z in zip(self.x.tolist(), self.y.tolist(), self.z.tolist()):
+            yield mercantile.Tile(x, y, z)
+
+    def __len__(self):
+        return len(self.keys)
+
+
 def tile_bbox(tile, mercator=False):
 
     if isinstance(tile, mercantile.Tile):
@@ -167,38 +520,70 @@ def tiles_to_granules(tiles, pg):
     return granules
 
 
-def tile_image_from_file(path, bands=None, force_rgb=False):
-    """Return a multiband image numpy array, from an image file path, or None."""
+def tile_image_from_file(path, bands=None, force_rgb=False, out=None, codec=None):
+    """Return a multiband H,W,C image numpy array, from an image file path, or packed store tile URI, or None.
+
+    Selected bands (1-based) are decoded in a single read, and written in out, a H,W,C preallocated buffer (or view),
+    if any and on the same dtype. Otherwise, out is left untouched, to be assigned (and upcast) by the caller.
+    Codec is picked on format: PIL for PNG, cv2 for WebP and JPEG, rasterio otherwise, unless codec is set.
+    """
 
     try:
-        if path[-3:] == "png" and force_rgb:  # PIL PNG Color Palette handling
-            return np.array(Image.open(os.path.expanduser(path)).convert("RGB"))
-        elif path[-3:] == "png":
-            return np.array(Image.open(os.path.expanduser(path)))
+        source, ext = tile_source(path)
+        codec = codec if codec else {"png": "pil", "webp": "cv2", "jpg": "cv2", "jpeg": "cv2"}.get(ext, "rasterio")
+
+        if codec == "pil":
+            image = Image.open(source)
+            image = np.array(image.convert("RGB") if force_rgb else image)  # PIL PNG Color Palette handling
+            indexes = None
+
+        elif codec == "cv2":
+            data = source.getvalue() if isinstance(source, io.BytesIO) else np.fromfile(source, dtype=np.uint8)
+            image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+            indexes = [2, 1, 0, 3] if len(image.shape) == 3 and image.shape[2] in [3, 4] else None  # BGR(A) -> RGB(A)
+
         else:
-            raster = rasterio_open(os.path.expanduser(path))
+            with rasterio_open(source) as raster:
+                image = raster.read(bands if bands else None)  # C,H,W all bands in a single read
+            image, indexes, bands = np.moveaxis(image, 0, 2), None, None  # H,W,C view, bands already selected
     except:
         return None
 
-    image = None
-    for i in raster.indexes if bands is None else bands:
-        data_band = raster.read(i)
-        data_band = data_band.reshape(data_band.shape[0], data_band.shape[1], 1)  # H,W -> H,W,C
-        image = np.concatenate((image, data_band), axis=2) if image is not None else data_band
+    image = image.reshape(image.shape[0], image.shape[1], -1)  # H,W -> H,W,C
+    indexes = list(range(image.shape[2])) if indexes is None else indexes[: image.shape[2]]
+    indexes = [indexes[band - 1] for band in bands] if bands else indexes
 
-    assert image is not None, "Unable to open {}".format(path)
-    return image
+    if out is not None and out.dtype != image.dtype:  # np.take would silently wrap values, on a narrower out
+        out = None
 
+    if out is None and indexes == list(range(image.shape[2])) and image.flags["C_CONTIGUOUS"]:
+        return image
 
-def tile_image_to_file(root, tile, image, ext=None):
-    """ Write an image tile on disk. """
+    return np.take(image, indexes, axis=2, out=out)
 
-    H, W, C = image.shape
+
+def tile_to_file(root, tile, data, ext):
+    """ Write an encoded tile, either on disk, or in a mbtiles:// packed store. """
+
+    store = tiles_store(root)
+    if store is not None:
+        assert isinstance(tile, mercantile.Tile), "Packed stores are only able to store XYZ tiles"
+        return store.put(tile, data, ext)
 
     root = os.path.expanduser(root)
     path = os.path.join(root, str(tile.z), str(tile.x)) if isinstance(tile, mercantile.Tile) else root
     os.makedirs(path, exist_ok=True)
 
+    path = os.path.join(path, "{}.{}".format(str(tile.y) if isinstance(tile, mercantile.Tile) else tile, ext))
+    with open(path, "wb") as fp:
+        fp.write(data)
+
+
+def tile_image_to_file(root, tile, image, ext=None):
+    """ Write an image tile on disk, or in a mbtiles:// packed store. """
+
+    H, W, C = image.shape
+
     if C == 1:
         ext = "png"
     elif C == 3:
@@ -206,59 +591,138 @@ def tile_image_to_file(root, tile, image, ext=None):
     else:
         ext = "tiff"
 
-    if isinstance(tile, mercantile.Tile):
-        path = os.path.join(path, "{}.{}".format(str(tile.y), ext))
-    else:
-        path = os.path.join(path, "{}.{}".format(tile, ext))
-
     try:
         if C == 1:
-            Image.fromarray(image.reshape(H, W), mode="L").save(path)
+            buffer = io.BytesIO()
+            Image.fromarray(image.reshape(H, W), mode="L").save(buffer, format="PNG")
+            data = buffer.getvalue()
         elif C == 3:
-            cv2.imwrite(path, cv2.cvtColor(image, cv2.COLOR_RGB2BGR))
+            data = cv2.imencode(".{}".format(ext), cv2.cvtColor(image, cv2.COLOR_RGB2BGR))[1].tobytes()
         else:
-            rasterio.open(path, "w", driver="GTiff", compress="lzw", height=H, width=W, count=C, dtype=image.dtype).write(
-                np.moveaxis(image, 2, 0)  # H,W,C -> C,H,W
-            )
+            with rasterio.io.MemoryFile() as memfile:
+                with memfile.open(driver="GTiff", compress="lzw", height=H, width=W, count=C, dtype=image.dtype) as out:
+                    out.write(np.moveaxis(image, 2, 0))  # H,W,C -> C,H,W
+                memfile.seek(0)
+                data = memfile.read()
+
+        tile_to_file(root, tile, data, ext)
     except:
-        assert False, "Unable to write {}".format(path)
+        assert False, "Unable to write {} in {}".format(tile, root)
 
 
 def tile_label_from_file(path, silent=True):
-    """Return a numpy array, from a label file path, or None."""
+    """Return a numpy array, from a label file path, or packed store tile URI, or None."""
 
     try:
-        return np.array(Image.open(os.path.expanduser(path))).astype(int)
+        return np.array(Image.open(tile_source(path)[0])).astype(int)
     except:
         assert silent, "Unable to open existing label: {}".format(path)
 
 
-def tile_label_to_file(root, tile, palette, transparency, label, append=False, margin=0):
-    """ Write a label (or a mask) tile on disk. """
-
-    root = os.path.expanduser(root)
-    dir_path = os.path.join(root, str(tile.z), str(tile.x)) if isinstance(tile, mercantile.Tile) else root
-    path = os.path.join(dir_path, "{}.png".format(str(tile.y)))
+def tile_label_to_file(root, tile, palette, transparency, label, append=False, margin=0, compress_level=None):
+    """ Write a label (or a mask) tile on disk, or in a mbtiles:// packed store.
+    Default PNG compression is the optimized (and slowest) one. """
 
     if len(label.shape) == 3:  # H,W,C -> H,W
         assert label.shape[2] == 1
         label = label.reshape((label.shape[0], label.shape[1]))
 
-    if append and os.path.isfile(path):
-        previous = tile_label_from_file(path, silent=False)
-        label = np.uint8(np.maximum(previous, label))
-    else:
-        os.makedirs(dir_path, exist_ok=True)
+    if append:  # labels are always PNG: a single store, or path, lookup, without any dir scan
+        store = tiles_store(root)
+        if store is not None:
+            data = store.get(tile)
+            previous = io.BytesIO(data) if data is not None else None
+        else:
+            path = os.path.join(os.path.expanduser(root), str(tile.z), str(tile.x), "{}.png".format(tile.y))
+            previous = path if os.path.isfile(path) else None
+
+        if previous is not None:
+            label = np.uint8(np.maximum(np.array(Image.open(previous)), label))
 
     try:
         out = Image.fromarray(label, mode="P")
         out.putpalette(palette)
+        options = {"optimize": True} if compress_level is None else {"compress_level": compress_level}
         if transparency is not None:
-            out.save(path, optimize=True, transparency=transparency)
-        else:
-            out.save(path, optimize=True)
+            options["transparency"] = transparency
+
+        buffer = io.BytesIO()
+        out.save(buffer, format="PNG", **options)
+        tile_to_file(root, tile, buffer.getvalue(), "png")
+    except:
+        assert False, "Unable to write {} in {}".format(tile, root)
+
+
+def tile_probs_to_file(root, tile, probs):
+    """ Write a C,H,W uint8 quantized classes scores tile on disk, or in a mbtiles:// packed store, as a lossless TIFF. """
+
+    C, H, W = probs.shape
+
+    try:
+        with rasterio.io.MemoryFile() as memfile:
+            with memfile.open(driver="GTiff", compress="deflate", height=H, width=W, count=C, dtype="uint8") as out:
+                out.write(probs)
+            memfile.seek(0)
+            data = memfile.read()
+
+        tile_to_file(root, tile, data, "tiff")
     except:
-        assert False, "Unable to write {}".format(path)
+        assert False, "Unable to write {} in {}".format(tile, root)
+
+
+def tile_probs_to_label(probs, threshold=0.5):
+    """ Return a label (or a mask) from a H,W,C uint8 quantized classes scores tile. """
+
+    classes = np.arange(probs.shape[2], dtype=np.uint8)
+    return np.sum((probs > threshold * 255) * classes, axis=2, dtype=np.uint8)
+
+
+class TilesWriter:
+    def __init__(self, workers, queue_size=None):
+        """Create an asynchronous tiles writer pool, blocking submits when more than queue_size tiles are pending."""
+
+        self.error = None
+        self.queued = 0  # tiles submitted, but not yet written
+        self.busy = 0.0  # cumulated seconds spent writing, by all threads
+        self.lock = threading.Lock()
+        self.executor = futures.ThreadPoolExecutor(workers)  # PIL and cv2 encoders release the GIL
+        self.pending = threading.BoundedSemaphore(queue_size if queue_size else 4 * workers)
+
+    def submit(self, write, *args, **kwargs):
+        """Queue a tile write (e.g tile_label_to_file), waiting for a free slot if the queue is full."""
+
+        assert self.error is None, self.error
+        self.pending.acquire()
+        with self.lock:
+            self.queued += 1
+        self.executor.submit(self.run, write, *args, **kwargs).add_done_callback(self.done)
+
+    def run(self, write, *args, **kwargs):
+        tick = time.monotonic()
+        try:
+            return write(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.busy += time.monotonic() - tick
+
+    def done(self, future):
+        with self.lock:
+            self.queued -= 1
+        self.pending.release()
+        if future.exception() is not None and self.error is None:
+            self.error = str(future.exception())
+
+    def close(self):
+        """Wait until every queued tile is written on disk."""
+
+        self.executor.shutdown(wait=True)
+        assert self.error is None, self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
 
 def tile_image_from_url(requests_session, url, timeout=10):
@@ -274,39 +738,73 @@ def tile_image_from_url(requests_session, url, timeout=10):
         return None
 
 
+def tile_strip_key(tile, strip=16):
+    """Sort key, walking tiles by vertical strips, strip tiles wide, and row by row in each: neighbours stay close."""
+
+    return (int(tile.z), int(tile.x) // strip, int(tile.y), int(tile.x))
+
+
+class TilesCache:
+    def __init__(self, size):
+        """LRU cache of decoded tiles images, bounded by size, in bytes. Not shared: one per process or loader worker."""
+
+        self.size = size
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.images = collections.OrderedDict()
+
+    def image(self, path, bands=None):
+        """Return a tile image, from cache if already decoded, otherwise from file. Cached images are read only."""
+
+        key = (path, tuple(bands) if bands else None)
+        if key in self.images:
+            self.hits += 1
+            self.images.move_to_end(key)
+            return self.images[key]
+
+        self.misses += 1
+        image = tile_image_from_file(path, bands)
+        if image is None or image.nbytes > self.size:
+            return image
+
+        self.images[key] = image
+        self.nbytes += image.nbytes
+        while self.nbytes > self.size:
+            _, evicted = self.images.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+        return image
+
+
 def tile_is_neighboured(tile, tiles):
-    """Check if a tile is surrounded by others tiles"""
+    """Check if a tile is surrounded by others tiles. To check a whole index at once, use TileIndex.neighboured."""
 
-    tiles = dict(tiles)
-    try:
-        # 3x3 matrix (upper, center, bottom) x (left, center, right)
-        tiles[mercantile.Tile(x=int(tile.x) - 1, y=int(tile.y) - 1, z=int(tile.z))]  # ul
-        tiles[mercantile.Tile(x=int(tile.x) + 0, y=int(tile.y) - 1, z=int(tile.z))]  # uc
-        tiles[mercantile.Tile(x=int(tile.x) + 1, y=int(tile.y) - 1, z=int(tile.z))]  # ur
-        tiles[mercantile.Tile(x=int(tile.x) - 1, y=int(tile.y) + 0, z=int(tile.z))]  # cl
-        tiles[mercantile.Tile(x=int(tile.x) + 1, y=int(tile.y) + 0, z=int(tile.z))]  # cr
-        tiles[mercantile.Tile(x=int(tile.x) - 1, y=int(tile.y) + 1, z=int(tile.z))]  # bl
-        tiles[mercantile.Tile(x=int(tile.x) + 0, y=int(tile.y) + 1, z=int(tile.z))]  # bc
-        tiles[mercantile.Tile(x=int(tile.x) + 1, y=int(tile.y) + 1, z=int(tile.z))]  # br
-    except KeyError:
-        return False
+    tiles = tiles if isinstance(tiles, TileIndex) else TileIndex(tiles)
+    x, y, z = int(tile.x), int(tile.y), int(tile.z)
+
+    # 3x3 matrix (upper, center, bottom) x (left, center, right), but center
+    xs = [x - 1, x, x + 1, x - 1, x + 1, x - 1, x, x + 1]
+    ys = [y - 1, y - 1, y - 1, y, y, y + 1, y + 1, y + 1]
 
-    return True
+    return bool(tiles.contains(xs, ys, z).all())
 
 
-def tile_image_buffer(tile, tiles, bands):
-    """Buffers a tile image adding borders on all sides based on adjacent tile, or zeros padded if not possible."""
+def tile_image_buffer(tile, tiles, bands, cache=None):
+    """Buffers a tile image adding borders on all sides based on adjacent tile, or zeros padded if not possible.
+
+    With a TilesCache, neighbours images already decoded are reused.
+    """
 
     def tile_image_neighbour(tile, dx, dy, tiles, bands):
         """Retrieves neighbour tile image if exists."""
-        try:
-            path = tiles[mercantile.Tile(x=int(tile.x) + dx, y=int(tile.y) + dy, z=int(tile.z))]
-        except KeyError:
+        path = tiles.path(tile, dx, dy)
+        if path is None:
             return None
 
-        return tile_image_from_file(path, bands)
+        return cache.image(path, bands) if cache is not None else tile_image_from_file(path, bands)
 
-    tiles = dict(tiles)
+    tiles = tiles if isinstance(tiles, TileIndex) else TileIndex(tiles)
     # 3x3 matrix (upper, center, bottom) x (left, center, right)
     ul = tile_image_neighbour(tile, -1, -1, tiles, bands)
     uc = tile_image_neighbour(tile, +0, -1, tiles, bands)
@@ -338,3 +836,34 @@ def tile_image_buffer(tile, tiles, bands):
     # fmt:on
 
     return img
+
+
+def tile_image_mosaic(tile, size, ts, border, tiles, bands, cache=None):
+    """Assembles a size x size tiles block image, from its upper-left tile, with a border based on adjacent tiles.
+
+    Missing tiles, inside the block or the border, are zeros padded. With a TilesCache, border tiles are reused.
+    """
+
+    tiles = tiles if isinstance(tiles, TileIndex) else TileIndex(tiles)
+    M = size * ts + 2 * border
+    img = None
+
+    for dy in range(-1, size + 1):
+        for dx in range(-1, size + 1):
+            path = tiles.path(tile, dx, dy)
+            if path is None:
+                continue
+
+            r0, c0 = border + dy * ts, border + dx * ts  # tile upper-left, in mosaic coordinates
+            r, c, rr, cc = max(r0, 0), max(c0, 0), min(r0 + ts, M), min(c0 + ts, M)
+            if r >= rr or c >= cc:
+                continue  # neighbour tile out of border
+
+            image = cache.image(path, bands) if cache is not None else tile_image_from_file(path, bands)
+            assert image is not None, "Unable to open {}".format(path)
+
+            img = np.zeros((M, M, image.shape[2]), dtype=np.uint8) if img is None else img
+            img[r:rr, c:cc, :] = image[r - r0 : rr - r0, c - c0 : cc - c0, :]
+
+    assert img is not None, "Empty mosaic {}".format(tile)
+    return img
@@ -11,7 +11,17 @@ import numpy as np
 from mercantile import feature
 
 from abd_model.core import web_ui, Logs, load_module, load_config
-from abd_model.tiles import tiles_from_dir, tile_from_xyz, tiles_from_csv, tile_image_from_file, tile_image_to_file
+from abd_model.tiles import (
+    tiles_from_dir,
+    tiles_from_csv,
+    tiles_from_manifest,
+    tile_image_from_file,
+    tile_image_to_file,
+    tile_source,
+    tiles_side_path,
+    tiles_store,
+    TileIndex,
+)
 
 
 def add_parser(subparser, formatter_class):
@@ -30,6 +40,7 @@ def add_parser(subparser, formatter_class):
     inp.add_argument("--config", type=str, help=help)
     inp.add_argument("--images", type=str, nargs="+", help="path to images directories [required for stack or side modes]")
     inp.add_argument("--cover", type=str, help="path to csv tiles cover file, to filter tiles to tile [optional]")
+    inp.add_argument("--manifest", type=str, help="path to abd predict manifest, to only compare non empty masks tiles")
     inp.add_argument("--workers", type=int, help="number of workers [default: CPU]")
 
     metric = parser.add_argument_group("Metrics Filtering")
@@ -64,7 +75,10 @@ def main(args):
         config = load_config(args.config)
 
     args.out = os.path.expanduser(args.out)
-    cover = [tile for tile in tiles_from_csv(os.path.expanduser(args.cover))] if args.cover else None
+    cover = TileIndex(tiles_from_csv(os.path.expanduser(args.cover))) if args.cover else None
+    if args.manifest:
+        non_empty = TileIndex(tiles_from_manifest(os.path.expanduser(args.manifest)))
+        cover = non_empty.select(cover.contains(non_empty.x, non_empty.y, non_empty.z)) if cover is not None else non_empty
 
     args_minmax = set()
     args.min = {(m[0], m[1]): m[2] for m in args.min} if args.min else dict()
@@ -89,27 +103,28 @@ def main(args):
     print("abd compare {} on CPU, with {} workers".format(args.mode, args.workers), file=sys.stderr, flush=True)
 
     if args.images:
-        tiles = [tile for tile in tiles_from_dir(args.images[0], cover=cover)]
+        images = [TileIndex(tiles_from_dir(root, cover=cover, xyz_path=True)) for root in args.images]
+        tiles = images[0]
         assert len(tiles), "Empty images dir: {}".format(args.images[0])
 
-        for image in args.images[1:]:
-            assert sorted(tiles) == sorted([tile for tile in tiles_from_dir(image, cover=cover)]), "Unconsistent images dirs"
+        for index in images[1:]:
+            assert tiles == index, "Unconsistent images dirs"
 
     if args.labels and args.masks:
-        tiles_masks = [tile for tile in tiles_from_dir(args.masks, cover=cover)]
-        tiles_labels = [tile for tile in tiles_from_dir(args.labels, cover=cover)]
+        tiles_masks = TileIndex(tiles_from_dir(args.masks, cover=cover, xyz_path=True))
+        tiles_labels = TileIndex(tiles_from_dir(args.labels, cover=cover, xyz_path=True))
         if args.images:
-            assert sorted(tiles) == sorted(tiles_masks) == sorted(tiles_labels), "Unconsistent images/label/mask directories"
+            assert tiles == tiles_masks == tiles_labels, "Unconsistent images/label/mask directories"
         else:
             assert len(tiles_masks), "Empty masks dir: {}".format(args.masks)
             assert len(tiles_labels), "Empty labels dir: {}".format(args.labels)
-            assert sorted(tiles_masks) == sorted(tiles_labels), "Label and Mask directories are not consistent"
+            assert tiles_masks == tiles_labels, "Label and Mask directories are not consistent"
             tiles = tiles_masks
 
     tiles_list = []
     tiles_compare = []
     progress = tqdm(total=len(tiles), ascii=True, unit="tile")
-    log = False if args.mode == "list" else Logs(os.path.join(args.out, "log"))
+    log = False if args.mode == "list" else Logs(tiles_side_path(args.out, "log"))
 
     with futures.ThreadPoolExecutor(args.workers) as executor:
 
@@ -118,8 +133,8 @@ def main(args):
 
             if args.masks and args.labels:
 
-                label = np.array(Image.open(os.path.join(args.labels, z, x, "{}.png".format(y))))
-                mask = np.array(Image.open(os.path.join(args.masks, z, x, "{}.png".format(y))))
+                label = np.array(Image.open(tile_source(tiles_labels.path(tile))[0]))
+                mask = np.array(Image.open(tile_source(tiles_masks.path(tile))[0]))
 
                 assert label.shape == mask.shape, "Inconsistent tiles (size or dimensions)"
 
@@ -142,8 +157,8 @@ def main(args):
             tiles_compare.append(tile)
 
             if args.mode == "side":
-                for i, root in enumerate(args.images):
-                    img = tile_image_from_file(tile_from_xyz(root, x, y, z)[1], force_rgb=True)
+                for i, index in enumerate(images):
+                    img = tile_image_from_file(index.path(tile), force_rgb=True)
 
                     if i == 0:
                         side = np.zeros((img.shape[0], img.shape[1] * len(args.images), 3))
@@ -160,8 +175,8 @@ def main(args):
                 tile_image_to_file(args.out, tile, np.uint8(side))
 
             elif args.mode == "stack":
-                for i, root in enumerate(args.images):
-                    tile_image = tile_image_from_file(tile_from_xyz(root, x, y, z)[1], force_rgb=True)
+                for i, index in enumerate(images):
+                    tile_image = tile_image_from_file(index.path(tile), force_rgb=True)
 
                     if i == 0:
                         image_shape = tile_image.shape[0:2]
@@ -213,6 +228,7 @@ def main(args):
             out.close()
 
     base_url = args.web_ui_base_url if args.web_ui_base_url else "."
+    args.no_web_ui = args.no_web_ui or tiles_store(args.out) is not None  # Web UI expects XYZ files
 
     if args.mode == "side" and not args.no_web_ui:
         template = "compare.html" if not args.web_ui_template else args.web_ui_template
@@ -4,7 +4,6 @@ import csv
 import json
 import math
 import psycopg2
-import collections
 
 from tqdm import tqdm
 from random import shuffle
@@ -13,7 +12,7 @@ from rasterio import open as rasterio_open
 from rasterio.warp import transform_bounds
 
 from abd_model.tiles import tiles_from_dir, tiles_from_csv, tiles_to_geojson
-from abd_model.geojson import geojson_srid, geojson_parse_feature
+from abd_model.geojson import geojson_srid, geojson_parse_polygons, geojson_polygon_tiles
 
 
 def add_parser(subparser, formatter_class):
@@ -90,16 +89,15 @@ def main(args):
 
     if args.geojson:
         print("abd cover from {} at zoom {}".format(args.geojson, args.zoom), file=sys.stderr, flush=True)
-        feature_map = collections.defaultdict(list)
+        cover = set()  # only tiles, features themselves are not kept
         for geojson_file in args.geojson:
             with open(os.path.expanduser(geojson_file)) as f:
                 feature_collection = json.load(f)
                 srid = geojson_srid(feature_collection)
 
                 for feature in tqdm(feature_collection["features"], ascii=True, unit="feature"):
-                    feature_map = geojson_parse_feature(args.zoom, srid, feature_map, feature)
-
-        cover = feature_map.keys()
+                    for polygon in geojson_parse_polygons(srid, feature):
+                        cover.update(geojson_polygon_tiles(args.zoom, polygon))
 
     if args.sql:
         print("abd cover from {} {} at zoom {}".format(args.sql, args.pg, args.zoom), file=sys.stderr, flush=True)
@@ -122,12 +120,10 @@ def main(args):
         db.execute(query)
         assert db.rowcount is not None and db.rowcount != -1, "SQL Query return no result."
 
-        feature_map = collections.defaultdict(list)
-
+        cover = set()
         for feature in tqdm(db.fetchall(), ascii=True, unit="feature"):  # FIXME: fetchall will not always fit in memory...
-            feature_map = geojson_parse_feature(args.zoom, 4326, feature_map, json.loads(feature[0]))
-
-        cover = feature_map.keys()
+            for polygon in geojson_parse_polygons(4326, json.loads(feature[0])):
+                cover.update(geojson_polygon_tiles(args.zoom, polygon))
 
     if args.bbox:
         try:
@@ -1,11 +1,15 @@
 import os
 import sys
+import json
+import time
 import torch
 import numpy as np
 from tqdm import tqdm
+import concurrent.futures as futures
 from torch.utils.data import DataLoader
 from abd_model.core import load_config, check_classes, check_channels
-from abd_model.tiles import tiles_from_dir, tile_label_from_file, tiles_from_csv
+from abd_model.tiles import tiles_from_dir, tile_label_from_file, tile_image_from_file, tiles_from_csv, TileIndex
+from abd_model.loaders.semseg import cache_key, stack_channel
 
 
 def add_parser(subparser, formatter_class):
@@ -15,8 +19,10 @@ def add_parser(subparser, formatter_class):
     parser.add_argument("--dataset", type=str, required=True, help="dataset path [required]")
     parser.add_argument("--cover", type=str, help="path to csv tiles cover file, to filter tiles dataset on [optional]")
     parser.add_argument("--workers", type=int, help="number of workers [default: CPU]")
+    help = "number of tiles to decode, per channel, in bench mode [default: 256]"
+    parser.add_argument("--bench_tiles", type=int, default=256, help=help)
 
-    choices = ["check", "weights"]
+    choices = ["check", "weights", "cache", "bench"]
     parser.add_argument("--mode", type=str, default="check", choices=choices, help="dataset mode [default: check]")
     parser.set_defaults(func=main)
 
@@ -49,6 +55,100 @@ def compute_classes_weights(dataset, classes, cover, workers):
     return weights.round(3, out=weights).tolist()
 
 
+def build_cache(dataset, config, cover, workers):
+    """Pre-decode dataset images channels and labels, in uint8 memory mapped arrays, then used by SemSeg train or eval."""
+
+    root = os.path.expanduser(dataset)
+    path = os.path.join(root, "cache")
+    os.makedirs(path, exist_ok=True)
+    if os.path.isfile(os.path.join(path, "index.json")):
+        os.remove(os.path.join(path, "index.json"))  # as invalid, until fully rebuilt
+
+    channels = [channel["name"] for channel in config["channels"]]
+    tiles = TileIndex(tiles_from_dir(os.path.join(root, channels[0]), cover=cover))  # as SemSeg does
+    assert len(tiles), "Empty Dataset"
+
+    paths = {name: TileIndex(tiles_from_dir(os.path.join(root, name), cover=tiles, xyz_path=True)) for name in channels}
+    paths["labels"] = TileIndex(tiles_from_dir(os.path.join(root, "labels"), cover=tiles, xyz_path=True))
+    for name, index in paths.items():
+        assert index == tiles, "Dataset inconsistency, missing {} tiles".format(name)
+
+    C = sum([len(channel["bands"]) for channel in config["channels"]])
+
+    def decode(tile, image=None):  # if any, channels directly decoded in image buffer
+        c = 0
+        for channel in config["channels"]:
+            bands = None if not channel["bands"] else channel["bands"]
+            out = image[:, :, c : c + len(bands)] if image is not None and bands else None
+            image_channel = tile_image_from_file(paths[channel["name"]].path(tile), bands, out=out)
+            assert image_channel is not None, "Dataset channel {} not retrieved: {}".format(channel["name"], tile)
+            image = stack_channel(image, image_channel, c, C)
+            c += image_channel.shape[2]
+
+        label = tile_label_from_file(paths["labels"].path(tile))
+        assert label is not None, "Dataset label not retrieved: {}".format(tile)
+
+        return image, label
+
+    image, label = decode(next(iter(tiles)))  # channels stacked on their np.result_type, as the loader does
+    H, W = label.shape
+    assert image.shape == (H, W, C), "Inconsistent image and label size: {}".format(next(iter(tiles)))
+    open_memmap = np.lib.format.open_memmap
+    images = open_memmap(os.path.join(path, "images.npy"), mode="w+", dtype=image.dtype, shape=(len(tiles), H, W, C))
+    labels = open_memmap(os.path.join(path, "labels.npy"), mode="w+", dtype=np.uint8, shape=(len(tiles), H, W))
+
+    progress = tqdm(desc="Dataset Cache", total=len(tiles), ascii=True, unit="tile")
+    with futures.ThreadPoolExecutor(workers) as executor:
+
+        def worker(row_tile):
+            row, tile = row_tile
+            tile_image, tile_label = decode(tile, images[row])  # images channels decoded in place
+            assert tile_image.shape == (H, W, C) and tile_label.shape == (H, W), "Inconsistent tile size: {}".format(tile)
+            assert tile_image.dtype == images.dtype, "Inconsistent tile dtype {}: {}".format(tile_image.dtype, tile)
+
+            labels[row] = tile_label
+            progress.update()
+
+        for _ in executor.map(worker, enumerate(tiles)):  # rows in TileIndex order
+            pass
+
+    images.flush()  # memory maps are then released on return
+    labels.flush()
+
+    with open(os.path.join(path, "index.json"), "w") as fp:  # lastly, as it makes the cache valid
+        json.dump({"key": cache_key(config, tiles), "tiles": len(tiles), "shape": [H, W, C]}, fp)
+
+    return len(tiles)
+
+
+def bench_decode(dataset, config, cover, tiles):
+    """Micro-benchmark images channels decoding, with per format codec (cv2, PIL or rasterio), against rasterio only."""
+
+    root = os.path.expanduser(dataset)
+    results = []
+    for channel in config["channels"]:
+        paths = [path for _, path in tiles_from_dir(os.path.join(root, channel["name"]), cover=cover, xyz_path=True)]
+        paths = paths[:tiles]
+        assert len(paths), "Empty Dataset channel: {}".format(channel["name"])
+        bands = None if not channel["bands"] else channel["bands"]
+
+        for path in paths:  # warm up OS page cache, to only bench decoding
+            tile_image_from_file(path, bands)
+
+        images = {}
+        for codec in [None, "rasterio"]:
+            tick = time.monotonic()
+            images[codec] = [tile_image_from_file(path, bands, codec=codec) for path in paths]
+            speed = len(paths) / (time.monotonic() - tick)
+            error = "Unable to decode {} with {}".format(channel["name"], codec)
+            assert all(image is not None for image in images[codec]), error
+
+            diff = max([int(np.abs(a.astype(np.int64) - b).max()) for a, b in zip(images[None], images[codec])])
+            results.append((channel["name"], codec if codec else "auto", speed, diff))
+
+    return results
+
+
 def main(args):
 
     assert os.path.isdir(os.path.expanduser(args.dataset)), "--dataset path is not a directory"
@@ -70,3 +170,16 @@ def main(args):
         check_classes(config)
         weights = compute_classes_weights(args.dataset, config["classes"], args.cover, args.workers)
         print(",".join(map(str, weights)))
+
+    if args.mode == "cache":
+        check_classes(config)
+        check_channels(config)
+        tiles = build_cache(args.dataset, config, args.cover, args.workers)
+        path = os.path.join(args.dataset, "cache")
+        print("abd dataset cache: {} tiles pre-decoded in {}".format(tiles, path), file=sys.stderr, flush=True)
+
+    if args.mode == "bench":
+        check_channels(config)
+        print("channel".ljust(20) + "codec".ljust(10) + "tiles/s".rjust(10) + "max diff".rjust(10))
+        for name, codec, speed, diff in bench_decode(args.dataset, config, args.cover, args.bench_tiles):
+            print(name.ljust(20) + codec.ljust(10) + "{:.1f}".format(speed).rjust(10) + str(diff).rjust(10))
@@ -8,7 +8,14 @@ from tqdm import tqdm
 from mercantile import xy_bounds
 
 from abd_model.core import web_ui, Logs
-from abd_model.tiles import tiles_from_csv, tile_image_from_url, tile_image_to_file
+from abd_model.tiles import (
+    tiles_from_csv,
+    tile_image_from_url,
+    tile_image_to_file,
+    tile_from_xyz,
+    tiles_store,
+    tiles_side_path,
+)
 
 
 def add_parser(subparser, formatter_class):
@@ -29,7 +36,7 @@ def add_parser(subparser, formatter_class):
 
     out = parser.add_argument_group("Output")
     out.add_argument("--format", type=str, default="webp", help="file format to save images in [default: webp]")
-    out.add_argument("--out", type=str, required=True, help="output directory path [required]")
+    out.add_argument("--out", type=str, required=True, help="output directory path, or mbtiles:// URI [required]")
 
     ui = parser.add_argument_group("Web UI")
     ui.add_argument("--web_ui_base_url", type=str, help="alternate Web UI base URL")
@@ -46,9 +53,10 @@ def main(args):
 
     args.workers = min(os.cpu_count(), args.rate) if not args.workers else args.workers
 
-    if os.path.dirname(os.path.expanduser(args.out)):
+    store = tiles_store(args.out)
+    if os.path.dirname(os.path.expanduser(args.out)) and store is None:
         os.makedirs(os.path.expanduser(args.out), exist_ok=True)
-    log = Logs(os.path.join(args.out, "log"), out=sys.stderr)
+    log = Logs(tiles_side_path(args.out, "log"), out=sys.stderr)
     log.log("abd download with {} workers, at max {} req/s, from: {}".format(args.workers, args.rate, args.url))
 
     already_dl = 0
@@ -63,15 +71,19 @@ def main(args):
                 tick = time.monotonic()
                 progress.update()
 
-                try:
-                    x, y, z = map(str, [tile.x, tile.y, tile.z])
-                    os.makedirs(os.path.join(args.out, z, x), exist_ok=True)
-                except:
-                    return tile, None, False
+                if store is not None:
+                    if tile_from_xyz(args.out, tile.x, tile.y, tile.z):  # already downloaded
+                        return tile, None, True
+                else:
+                    try:
+                        x, y, z = map(str, [tile.x, tile.y, tile.z])
+                        os.makedirs(os.path.join(args.out, z, x), exist_ok=True)
+                    except:
+                        return tile, None, False
 
-                path = os.path.join(args.out, z, x, "{}.{}".format(y, args.format))
-                if os.path.isfile(path):  # already downloaded
-                    return tile, None, True
+                    path = os.path.join(args.out, z, x, "{}.{}".format(y, args.format))
+                    if os.path.isfile(path):  # already downloaded
+                        return tile, None, True
 
                 if args.type == "XYZ":
                     url = args.url.format(x=tile.x, y=tile.y, z=tile.z)
@@ -113,7 +125,7 @@ def main(args):
     if already_dl + dl == len(tiles):
         log.log("Notice: Coverage is fully downloaded.")
 
-    if not args.no_web_ui:
+    if not args.no_web_ui and store is None:  # Web UI expects XYZ files
         template = "leaflet.html" if not args.web_ui_template else args.web_ui_template
         base_url = args.web_ui_base_url if args.web_ui_base_url else "."
         web_ui(args.out, base_url, tiles, tiles, args.format, template)
@@ -1,4 +1,5 @@
 import os
+import re
 import sys
 import uuid
 import torch
@@ -108,10 +109,8 @@ def main(args):
 
     else:
 
-        try:  # https://github.com/pytorch/pytorch/issues/9176
-            nn.module.state_dict(chkpt["state_dict"])
-        except AttributeError:
-            nn.state_dict(chkpt["state_dict"])
+        # Checkpoints are saved from a DistributedDataParallel wrapper, cf https://github.com/pytorch/pytorch/issues/9176
+        nn.load_state_dict({re.sub(r"^module\.", "", k): v for k, v in chkpt["state_dict"].items()})
 
         nn.eval()
 
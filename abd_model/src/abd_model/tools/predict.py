@@ -1,5 +1,9 @@
 import os
+import re
+import json
 import uuid
+import threading
+import functools
 from tqdm import tqdm
 
 import math
@@ -7,13 +11,22 @@ import mercantile
 import numpy as np
 
 import torch
-import torch.distributed as dist
 import torch.multiprocessing as mp
 from torch.utils.data import DataLoader
-from torch.nn.parallel import DistributedDataParallel
 
-from abd_model.core import load_config, load_module, check_classes, check_channels, make_palette, web_ui, Logs
-from abd_model.tiles import tile_label_to_file, tiles_from_csv
+from abd_model.core import load_config, load_module, check_classes, check_channels, make_palette, web_ui, Logs, Timer
+from abd_model.autotune import autotune
+from abd_model.loaders.semseg import LocalitySampler
+from abd_model.tiles import (
+    tile_label_to_file,
+    tile_probs_to_file,
+    tiles_from_csv,
+    tiles_store,
+    tiles_stores_close,
+    tiles_side_path,
+    TilesWriter,
+    TileIndex,
+)
 
 
 def add_parser(subparser, formatter_class):
@@ -23,18 +36,48 @@ def add_parser(subparser, formatter_class):
 
     inp = parser.add_argument_group("Inputs")
     inp.add_argument("--dataset", type=str, help="predict dataset directory path [required]")
-    inp.add_argument("--checkpoint", type=str, required=True, help="path to the trained model to use [required]")
+    inp.add_argument("--checkpoint", type=str, help="path to the trained model to use [required, with torch engine]")
+    inp.add_argument("--model", type=str, help="path to an ONNX exported model [required, with onnxruntime engine]")
     inp.add_argument("--config", type=str, help="path to config file [required, if no global config setting]")
     inp.add_argument("--cover", type=str, help="path to csv tiles cover file, to filter tiles to predict [optional]")
 
     out = parser.add_argument_group("Outputs")
-    out.add_argument("--out", type=str, required=True, help="output directory path [required]")
+    out.add_argument("--out", type=str, required=True, help="output directory path, or mbtiles:// URI [required]")
+    out.add_argument("--resume", action="store_true", help="if set, only predict tiles not already in out manifest")
+    out.add_argument("--skip_empty", action="store_true", help="if set, don't write masks without any feature")
+    help = "if set, output directory path to also store quantized classes scores in, nn outputs clipped to [0,1]"
+    out.add_argument("--probs", type=str, help=help)
     out.add_argument("--metatiles", action="store_true", help="if set, use surrounding tiles to avoid margin effects")
-    out.add_argument("--keep_borders", action="store_true", help="if set, with --metatiles, force borders tiles to be kept")
+    help = "if set, with --metatiles or --mosaic, keep cover tiles lacking a neighbour, instead of skipping them."
+    help += " With --mosaic, their missing neighbours are then zeros padded in the --overlap border"
+    out.add_argument("--keep_borders", action="store_true", help=help)
+    help = "masks PNG compression level, from 0 (none) to 9 (max) [default: 6]"
+    out.add_argument("--compress_level", type=int, default=6, choices=range(0, 10), metavar="[0-9]", help=help)
+    help = "if set, predict by K x K tiles mosaics, with a sliding window, instead of --metatiles (e.g 8) [optional]"
+    out.add_argument("--mosaic", type=int, help=help)
+    out.add_argument("--overlap", type=int, help="with --mosaic, sliding windows overlap, in pixels [default: ts/8]")
+    choices = ["mean", "linear"]
+    help = "with --mosaic, overlapping windows blending [default: linear]"
+    out.add_argument("--blending", type=str, default="linear", choices=choices, help=help)
 
     perf = parser.add_argument_group("Performances")
-    perf.add_argument("--bs", type=int, help="batch size [default: CPU/GPU]")
-    perf.add_argument("--workers", type=int, help="number of pre-processing images workers, per GPU [default: batch_size]")
+    choices = ["torch", "onnxruntime"]
+    perf.add_argument("--engine", type=str, default="torch", choices=choices, help="inference engine [default: torch]")
+    choices = ["cuda", "cpu"]
+    perf.add_argument("--device", type=str, choices=choices, help="device to predict on [default: cuda if available]")
+    perf.add_argument("--procs", type=int, help="number of processes, with --device cpu [default: CPU/8]")
+    perf.add_argument("--threads", type=int, help="number of compute threads, per CPU process [default: CPU/procs]")
+    perf.add_argument("--inter_threads", type=int, default=1, help="onnxruntime inter-op threads, per process [default: 1]")
+    choices = ["disable", "basic", "extended", "all"]
+    help = "onnxruntime graph optimization level [default: all]"
+    perf.add_argument("--graph_optimization", type=str, default="all", choices=choices, help=help)
+    perf.add_argument("--bs", type=int, help="batch size [default: CPU/GPU, or 4 on CPU]")
+    perf.add_argument("--workers", type=int, help="number of pre-processing images workers, per process [default: bs]")
+    help = "with --metatiles or --mosaic, decoded tiles cache size, per loader worker, in MB [default: 256]"
+    perf.add_argument("--cache", type=int, default=256, help=help)
+    perf.add_argument("--writers", type=int, default=2, help="number of masks writing threads, per process [default: 2]")
+    help = "if set, probe batch sizes and workers on the dataset, and use the fastest ones (overrides --bs --workers)"
+    perf.add_argument("--autotune", action="store_true", help=help)
 
     ui = parser.add_argument_group("Web UI")
     ui.add_argument("--web_ui_base_url", type=str, help="alternate Web UI base URL")
@@ -44,56 +87,323 @@ def add_parser(subparser, formatter_class):
     parser.set_defaults(func=main)
 
 
-def gpu_worker(rank, world_size, lock_file, args, config, dataset, palette, transparency):
+def onnxruntime_session(args):
+    """Open an ONNX Runtime inference session, on CPU, from an exported model."""
+
+    try:
+        import onnxruntime
+    except ImportError:
+        assert False, "onnxruntime engine requires onnxruntime. Check your install."
+
+    levels = {
+        "disable": onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+    }
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = args.threads
+    options.inter_op_num_threads = args.inter_threads
+    options.graph_optimization_level = levels[args.graph_optimization]
+
+    session = onnxruntime.InferenceSession(os.path.expanduser(args.model), options)
+    assert session, "Unable to load ONNX model {}".format(args.model)
+
+    return session
 
-    dist.init_process_group(backend="nccl", init_method="file://" + lock_file, world_size=world_size, rank=rank)
-    torch.cuda.set_device(rank)
-    chkpt = torch.load(args.checkpoint, map_location=torch.device(rank))
-    nn_module = load_module("abd_model.nn.{}".format(chkpt["nn"].lower()))
-    nn = getattr(nn_module, chkpt["nn"])(chkpt["shape_in"], chkpt["shape_out"], chkpt["encoder"].lower()).to(rank)
-    nn = DistributedDataParallel(nn, device_ids=[rank], find_unused_parameters=True)
 
-    chkpt = torch.load(os.path.expanduser(args.checkpoint), map_location="cuda:{}".format(rank))
-    assert nn.module.version == chkpt["model_version"], "Model Version mismatch"
-    nn.load_state_dict(chkpt["state_dict"])
+def load_nn(args, device):
+    """Return the model forward function, taking and returning N,C,H,W torch tensors.
 
-    sampler = torch.utils.data.distributed.DistributedSampler(dataset, num_replicas=world_size, rank=rank)
-    loader = DataLoader(dataset, batch_size=args.bs, shuffle=False, num_workers=args.workers, sampler=sampler)
-    assert len(loader), "Empty predict dataset directory. Check your path."
+    Not wrapped in DistributedDataParallel: inference needs no collectives, and a rank without any batch to predict
+    would otherwise never join the first forward buffers broadcast, leaving others ranks crashed or hung.
+    """
 
-    C, W, H = chkpt["shape_out"]
+    if args.engine == "onnxruntime":
+        session = onnxruntime_session(args)
+        input_name = session.get_inputs()[0].name
+
+        def nn(images):
+            return torch.from_numpy(session.run(None, {input_name: np.ascontiguousarray(images.numpy())})[0])
+
+        return nn
+
+    chkpt = torch.load(os.path.expanduser(args.checkpoint), map_location=device)
+    nn_module = load_module("abd_model.nn.{}".format(chkpt["nn"].lower()))
+    nn = getattr(nn_module, chkpt["nn"])(chkpt["shape_in"], chkpt["shape_out"], chkpt["encoder"].lower()).to(device)
+    assert nn.version == chkpt["model_version"], "Model Version mismatch"
+
+    nn.load_state_dict({re.sub(r"^module\.", "", k): v for k, v in chkpt["state_dict"].items()})
 
     nn.eval()
-    with torch.no_grad():
 
-        dataloader = tqdm(loader, desc="Predict", unit="Batch/GPU", ascii=True) if rank == 0 else loader
+    return nn
+
+
+def mosaic_probs(nn, image, ts, overlap, blending, bs):
+    """Sliding window inference on a C,H,W mosaic image, returning blended probabilities."""
+
+    _, H, W = image.shape
+    stride = ts - overlap
+
+    def offsets(size):
+        offsets = list(range(0, size - ts + 1, stride))
+        return offsets if offsets[-1] == size - ts else offsets + [size - ts]
+
+    if blending == "linear":  # weights decrease linearly, in the overlap, toward window borders
+        ramp = torch.arange(ts, dtype=torch.float, device=image.device)
+        ramp = torch.min(ramp + 1, ts - ramp).clamp(max=max(overlap, 1)) / max(overlap, 1)
+        weight = ramp.view(-1, 1) * ramp.view(1, -1)
+    else:
+        weight = torch.ones((ts, ts), dtype=torch.float, device=image.device)
+
+    probs = None
+    weights = torch.zeros((H, W), dtype=torch.float, device=image.device)
+    windows = [(y, x) for y in offsets(H) for x in offsets(W)]
+
+    for i in range(0, len(windows), bs):
+        batch = windows[i : i + bs]
+        outputs = nn(torch.stack([image[:, y : y + ts, x : x + ts] for y, x in batch])).to(image.device)
+        probs = torch.zeros((outputs.shape[1], H, W), dtype=torch.float, device=image.device) if probs is None else probs
+
+        for (y, x), output in zip(batch, outputs):
+            probs[:, y : y + ts, x : x + ts] += output * weight
+            weights[y : y + ts, x : x + ts] += weight
+
+    return probs / weights
+
+
+def forward(nn, images, tiles, args, dataset, bs):
+    """Predict N,C,H,W probabilities, on images device, from an images batch. With mosaic, bs is the windows batch size."""
+
+    C, W, H = dataset.shape_out
+
+    if args.mosaic:
+        o = args.overlap
+        x, y, z = list(map(int, tiles[0]))
+        mosaic = mosaic_probs(nn, images[0], W, o, args.blending, bs)
+
+        # split mosaic back into XYZ tiles
+        blocks = [(dx, dy) for dy in range(args.mosaic) for dx in range(args.mosaic)]
+        blocks = [(dx, dy) for dx, dy in blocks if mercantile.Tile(x + dx, y + dy, z) in dataset.cover]
+        tiles = [(x + dx, y + dy, z) for dx, dy in blocks]
+        windows = [(o + dy * H, o + dx * W) for dx, dy in blocks]
+        probs = torch.stack([mosaic[:, r : r + H, c : c + W] for r, c in windows])
+
+    elif args.metatiles:
+        N = images.shape[0]
+        qs = int(W / 4)
+        hs = int(W / 2)
+        ts = int(W)
+
+        # fmt:off
+        probs = torch.zeros((N, C, W, H), dtype=torch.float, device=images.device)
+        probs[:, :, 0:hs, 0:hs] = nn(images[:, :, 0:ts, 0:ts])[:, :, qs:-qs, qs:-qs]
+        probs[:, :, 0:hs,  hs:] = nn(images[:, :, 0:ts,  hs:])[:, :, qs:-qs, qs:-qs]
+        probs[:, :, hs:,  0:hs] = nn(images[:, :, hs:,  0:ts])[:, :, qs:-qs, qs:-qs]
+        probs[:, :, hs:,   hs:] = nn(images[:, :, hs:,   hs:])[:, :, qs:-qs, qs:-qs]
+        # fmt:on
+    else:
+        probs = nn(images).to(images.device)
+
+    return tiles, probs
+
+
+def probs_to_masks(probs):
+    """Compute, on device, N,H,W uint8 classes masks from N,C,H,W nn outputs, thresholded at 0.5."""
+
+    C = probs.shape[1]
+    classes = torch.arange(C, dtype=torch.uint8, device=probs.device).view(1, C, 1, 1)
+    return ((probs > 0.5).to(torch.uint8) * classes).sum(dim=1, dtype=torch.uint8)
+
+
+def scores_to_uint8(probs):
+    """Quantize, on device, N,C,H,W nn outputs to uint8 classes scores.
+
+    Scores are the raw nn outputs, clipped to [0,1], not softmaxed ones: as Lovasz trained nn outputs are regressed on
+    0 or 1 classes masks, and masks thresholded at 0.5 on them, a 128 score is the masks threshold (cf abd threshold).
+    """
+
+    return (probs.clamp(0.0, 1.0) * 255).round().to(torch.uint8)
+
+
+def masks_stats(probs, masks):
+    """Compute, on device, N,6 masks stats: non background pixels, max class score, and positives bbox or -1."""
+
+    N, C, H, W = probs.shape
+    positives = masks > 0
+    pixels = positives.flatten(1).sum(dim=1).float()
+    max_score = probs[:, 1:].flatten(1).max(dim=1)[0].float().clamp(0.0, 1.0)  # as quantized scores are
+
+    cols, rows = positives.any(dim=1), positives.any(dim=2)  # N,W and N,H
+    xs = torch.arange(W, device=probs.device).expand(N, W)
+    ys = torch.arange(H, device=probs.device).expand(N, H)
+    xmin = torch.where(cols, xs, torch.full_like(xs, W)).min(dim=1)[0]
+    xmax = torch.where(cols, xs, torch.full_like(xs, -1)).max(dim=1)[0]
+    ymin = torch.where(rows, ys, torch.full_like(ys, H)).min(dim=1)[0]
+    ymax = torch.where(rows, ys, torch.full_like(ys, -1)).max(dim=1)[0]
+
+    bbox = torch.stack([xmin, ymin, xmax, ymax], dim=1).float()
+    bbox[pixels == 0] = -1
+
+    return torch.cat([pixels.unsqueeze(1), max_score.unsqueeze(1), bbox], dim=1)
+
+
+class Manifest:
+    def __init__(self, path):
+        """Open an append-only manifest, listing completed tiles, shared between processes and threads."""
+
+        self.lock = threading.Lock()
+        self.fp = open(path, mode="a")
+
+    def add(self, tile, stats):
+        """Add a tile, with its non background pixels, max class score, and positives bbox (xmin,ymin,xmax,ymax)."""
+
+        pixels, max_score, xmin, ymin, xmax, ymax = stats
+        bbox = ",".join(map(str, map(int, (xmin, ymin, xmax, ymax))))
+        row = "{},{},{},{},{:.3f},{}{}".format(tile.x, tile.y, tile.z, int(pixels), max_score, bbox, os.linesep)
+
+        with self.lock:  # each line is flushed in a single, O_APPEND, write, and synced to survive a crash
+            self.fp.write(row)
+            self.fp.flush()
+            os.fsync(self.fp.fileno())
+
+    def close(self):
+        self.fp.close()
+
+
+def manifest_resume(path):
+    """Retrieve tiles from a manifest, truncating it after its last complete row, if a crash left one half written."""
+
+    done, size = set(), 0
+    with open(path, mode="rb+") as fp:
+        for row in fp:
+            cols = row.decode("ascii", errors="replace").rstrip().split(",")
+            if not row.endswith(b"\n") or len(cols) < 3 or not all(col.isdigit() for col in cols[0:3]):
+                break
+
+            done.add(mercantile.Tile(int(cols[0]), int(cols[1]), int(cols[2])))
+            size += len(row)
+
+        fp.truncate(size)
+
+    return done
+
+
+def write_tile(args, manifest, tile, palette, transparency, mask, stats, probs=None):
+    """Write a predicted tile on disk, and then only, add it to the manifest."""
+
+    if stats[0] or not args.skip_empty:
+        tile_label_to_file(args.out, tile, palette, transparency, mask, compress_level=args.compress_level)
+    if probs is not None:
+        tile_probs_to_file(args.probs, tile, probs)
+
+    store = tiles_store(args.out)
+    if store is not None:  # as packed store writes are batched, only once committed
+        store.committed(functools.partial(manifest.add, tile, stats))
+    else:
+        manifest.add(tile, stats)
+
+
+def worker(rank, world_size, run, args, config, dataset, palette, transparency):
+
+    if args.device == "cuda":
+        torch.cuda.set_device(rank)
+        device = torch.device("cuda:{}".format(rank))
+    else:
+        torch.set_num_threads(args.threads)  # avoid oversubscription between processes
+        device = torch.device("cpu")
+
+    nn = load_nn(args, device)
+
+    bs = 1 if args.mosaic else args.bs  # with mosaic, args.bs is the sliding windows batch size
+    sampler = LocalitySampler(dataset, num_replicas=world_size, rank=rank, bs=bs, workers=args.workers)
+    loader = DataLoader(dataset, batch_sampler=sampler, num_workers=args.workers)
+
+    manifest = Manifest(tiles_side_path(args.out, "manifest.csv"))
+    timer = Timer(tiles_side_path(args.out, "metrics.jsonl"), run=run, rank=rank)
+
+    def lap(stage):
+        if args.device == "cuda":
+            torch.cuda.synchronize(device)  # as CUDA kernels are asynchronous
+        timer.lap(stage)
+
+    with torch.no_grad(), TilesWriter(args.writers) as writer:
+
+        unit = "Batch/GPU" if args.device == "cuda" else "Batch/Process"
+        dataloader = tqdm(loader, desc="Predict", unit=unit, ascii=True) if rank == 0 else loader
 
         for images, tiles in dataloader:
+            lap("data")
+
+            images = images.to(device)
+            lap("h2d")
+
+            tiles, probs = forward(nn, images, tiles, args, dataset, args.bs)
+            lap("forward")
 
-            if args.metatiles:
-                N = images.shape[0]
-                qs = int(W / 4)
-                hs = int(W / 2)
-                ts = int(W)
-
-                # fmt:off
-                probs = np.zeros((N, C, W, H), dtype=np.float)
-                probs[:, :, 0:hs, 0:hs] = nn(images[:, :, 0:ts, 0:ts].to(rank)).data.cpu().numpy()[:, :, qs:-qs, qs:-qs]
-                probs[:, :, 0:hs,  hs:] = nn(images[:, :, 0:ts,  hs:].to(rank)).data.cpu().numpy()[:, :, qs:-qs, qs:-qs]
-                probs[:, :, hs:,  0:hs] = nn(images[:, :, hs:,  0:ts].to(rank)).data.cpu().numpy()[:, :, qs:-qs, qs:-qs]
-                probs[:, :, hs:,   hs:] = nn(images[:, :, hs:,   hs:].to(rank)).data.cpu().numpy()[:, :, qs:-qs, qs:-qs]
-                # fmt:on
-            else:
-                probs = nn(images.to(rank)).data.cpu().numpy()
-
-            for tile, prob in zip(tiles, probs):
+            masks = probs_to_masks(probs)
+            stats = masks_stats(probs, masks).cpu().numpy()
+            masks = masks.cpu().numpy()
+            probs = scores_to_uint8(probs).cpu().numpy() if args.probs else [None] * len(masks)
+            lap("post")
+
+            for tile, mask, stat, prob in zip(tiles, masks, stats, probs):
                 x, y, z = list(map(int, tile))
-                mask = np.zeros((W, H), dtype=np.uint8)
+                writer.submit(write_tile, args, manifest, mercantile.Tile(x, y, z), palette, transparency, mask, stat, prob)
+            lap("submit")
+
+            timer.record(counters={"tiles": len(tiles)}, gauges={"queue": writer.queued})
+
+    tiles_stores_close()  # as spawned processes exit without atexit handlers
+    lap("flush")
+    timer.summary(write=writer.busy)
+    timer.close()
+    manifest.close()
+
+
+def autotune_predict(args, dataset, world_size, log):
+    """Probe, in a single process, on first device, predict batch sizes and workers, and return the fastest ones."""
+
+    if args.device == "cuda":
+        device = torch.device("cuda:0")
+        max_bs = 64
+    else:
+        torch.set_num_threads(args.threads)
+        device = torch.device("cpu")
+        max_bs = 16
+
+    nn = load_nn(args, device)
+
+    def step(batch, bs):
+        images, tiles = batch
+        tiles, probs = forward(nn, images.to(device), tiles, args, dataset, bs)
+        masks_stats(probs, probs_to_masks(probs)).cpu()
+        return len(tiles)
+
+    max_workers = max(1, math.floor(os.cpu_count() / world_size))
+    loader_bs = 1 if args.mosaic else None
+    with torch.no_grad():
+        bs, workers = autotune(dataset, step, device, max_bs, max_workers, log, loader_bs=loader_bs)
+
+    return bs, workers  # probed model is released on return
 
-                for c in range(C):
-                    mask += np.around(prob[c, :, :]).astype(np.uint8) * c
 
-                tile_label_to_file(args.out, mercantile.Tile(x, y, z), palette, transparency, mask)
+def log_timings(log, path, run):
+    """Log a summary table, from a predict run timings, as recorded in the metrics file."""
+
+    with open(path) as fp:
+        summaries = [record for record in map(json.loads, fp) if record.get("summary") and record["run"] == run]
+
+    stages = ["data", "h2d", "forward", "post", "submit", "flush", "write"]
+    log.log("---")
+    log.log("Timings, in seconds (write is cumulated among writers threads):")
+    log.log("".join(column.ljust(10) for column in ["rank", "tiles", "tiles/s", "elapsed"] + stages + ["max_queue"]))
+    for summary in sorted(summaries, key=lambda summary: summary["rank"]):
+        row = [summary["rank"], summary.get("tiles", 0), summary.get("tiles/s", 0.0), summary["elapsed"]]
+        row += [summary.get(stage, 0.0) for stage in stages] + [summary.get("max_queue", 0)]
+        log.log("".join("{:.2f}".format(v).ljust(10) if isinstance(v, float) else str(v).ljust(10) for v in row))
 
 
 def main(args):
@@ -101,43 +411,98 @@ def main(args):
     check_channels(config)
     check_classes(config)
 
-    assert torch.cuda.is_available(), "No GPU support found. Check CUDA and NVidia Driver install."
-    assert torch.distributed.is_nccl_available(), "No NCCL support found. Check your PyTorch install."
-
-    world_size = torch.cuda.device_count()
-    args.bs = args.bs if args.bs is not None else math.floor(os.cpu_count() / world_size)
-    args.workers = args.workers if args.workers is not None else args.bs
+    assert not (args.mosaic and args.metatiles), "--mosaic and --metatiles are mutually exclusive"
+    assert not args.mosaic or args.mosaic > 0, "--mosaic expects a strictly positive tiles number"
+
+    if args.engine == "onnxruntime":
+        assert args.model, "--model is mandatory with onnxruntime engine"
+        assert args.device != "cuda", "onnxruntime engine is only available on CPU"
+        args.device = "cpu"
+    else:
+        assert args.checkpoint, "--checkpoint is mandatory with torch engine"
+        args.device = args.device if args.device else ("cuda" if torch.cuda.is_available() else "cpu")
+
+    if args.device == "cuda":
+        assert torch.cuda.is_available(), "No GPU support found. Check CUDA and NVidia Driver install."
+        assert torch.distributed.is_nccl_available(), "No NCCL support found. Check your PyTorch install."
+
+        world_size = torch.cuda.device_count()
+        args.bs = args.bs if args.bs is not None else math.floor(os.cpu_count() / world_size)
+        args.workers = args.workers if args.workers is not None else args.bs
+    else:
+        if args.engine == "torch":
+            assert torch.distributed.is_gloo_available(), "No Gloo support found. Check your PyTorch install."
+
+        world_size = args.procs if args.procs else max(1, math.floor(os.cpu_count() / 8))
+        args.bs = args.bs if args.bs is not None else 4
+        args.workers = args.workers if args.workers is not None else 1
+        args.threads = args.threads if args.threads else max(1, math.floor(os.cpu_count() / world_size) - args.workers)
 
     palette, transparency = make_palette([classe["color"] for classe in config["classes"]])
-    args.cover = [tile for tile in tiles_from_csv(os.path.expanduser(args.cover))] if args.cover else None
+    args.cover = TileIndex(tiles_from_csv(os.path.expanduser(args.cover))) if args.cover else None
 
     args.out = os.path.expanduser(args.out)
-    log = Logs(os.path.join(args.out, "log"))
-
-    chkpt = torch.load(args.checkpoint, map_location=torch.device("cpu"))
-    log.log("abd predict on {} GPUs, with {} workers/GPU and {} tiles/batch".format(world_size, args.workers, args.bs))
-    log.log("Model {} - UUID: {}".format(chkpt["nn"], chkpt["uuid"]))
+    args.probs = os.path.expanduser(args.probs) if args.probs else None
+    log = Logs(tiles_side_path(args.out, "log"))
+
+    manifest_path = tiles_side_path(args.out, "manifest.csv")
+    done = manifest_resume(manifest_path) if args.resume and os.path.isfile(manifest_path) else set()
+    if not args.resume and os.path.isfile(manifest_path):
+        os.remove(manifest_path)
+
+    if args.device == "cuda":
+        log.log("abd predict on {} GPUs, with {} workers/GPU and {} tiles/batch".format(world_size, args.workers, args.bs))
+    else:
+        msg = "abd predict on CPU, with {} processes, {} threads and {} workers/process, and {} tiles/batch"
+        log.log(msg.format(world_size, args.threads, args.workers, args.bs))
+
+    if args.engine == "onnxruntime":
+        _, _, H, W = onnxruntime_session(args).get_inputs()[0].shape  # spatial axes are static on export
+        ts = (W, H) if isinstance(W, int) and isinstance(H, int) else config["model"]["ts"]
+        loader_name = config["model"]["loader"]
+        log.log("Model {} - ONNX Runtime, with {} graph optimization".format(args.model, args.graph_optimization))
+    else:
+        chkpt = torch.load(os.path.expanduser(args.checkpoint), map_location=torch.device("cpu"))
+        ts = chkpt["shape_in"][1:3]
+        loader_name = chkpt["loader"]
+        log.log("Model {} - UUID: {}".format(chkpt["nn"], chkpt["uuid"]))
     log.log("---")
-    loader = load_module("abd_model.loaders.{}".format(chkpt["loader"].lower()))
 
-    lock_file = os.path.abspath(os.path.join(args.out, str(uuid.uuid1())))
+    if args.mosaic:
+        args.overlap = args.overlap if args.overlap is not None else int(ts[0] / 8)
+        assert 0 <= args.overlap < ts[0], "--overlap must be lower than tile size"
+
+    loader = load_module("abd_model.loaders.{}".format(loader_name.lower()))
 
-    dataset = getattr(loader, chkpt["loader"])(
+    run = str(uuid.uuid1())  # metrics run id
+
+    dataset = getattr(loader, loader_name)(
         config,
-        chkpt["shape_in"][1:3],
+        ts,
         args.dataset,
         args.cover,
         mode="predict",
         metatiles=args.metatiles,
         keep_borders=args.keep_borders,
+        mosaic=args.mosaic,
+        mosaic_border=args.overlap,
+        skip=done,
+        cache_size=args.cache * 1024 * 1024,
     )
 
-    mp.spawn(gpu_worker, nprocs=world_size, args=(world_size, lock_file, args, config, dataset, palette, transparency))
+    if done:
+        log.log("Resume: {} tiles already predicted, {} tiles left".format(len(done), len(dataset.cover)))
+
+    if args.autotune and len(dataset):
+        args.bs, args.workers = autotune_predict(args, dataset, world_size, log)
+        torch.cuda.empty_cache() if args.device == "cuda" else None
 
-    if os.path.exists(lock_file):
-        os.remove(lock_file)
+    if len(dataset):
+        mp.spawn(worker, nprocs=world_size, args=(world_size, run, args, config, dataset, palette, transparency))
+        log_timings(log, tiles_side_path(args.out, "metrics.jsonl"), run)
 
-    if not args.no_web_ui and dataset.cover:
+    cover = set(dataset.cover) | done
+    if not args.no_web_ui and cover and tiles_store(args.out) is None:  # Web UI expects XYZ files
         template = "leaflet.html" if not args.web_ui_template else args.web_ui_template
         base_url = args.web_ui_base_url if args.web_ui_base_url else "."
-        web_ui(args.out, base_url, dataset.cover, dataset.cover, "png", template)
+        web_ui(args.out, base_url, cover, cover, "png", template)
@@ -1,7 +1,9 @@
+import io
 import os
 import re
 import sys
 import json
+import itertools
 import collections
 
 import numpy as np
@@ -12,8 +14,15 @@ import concurrent.futures as futures
 import psycopg2
 
 from abd_model.core import load_config, check_classes, make_palette, web_ui, Logs
-from abd_model.tiles import tiles_from_csv, tile_label_to_file, tile_bbox
-from abd_model.geojson import geojson_srid, geojson_tile_burn, geojson_parse_feature
+from abd_model.tiles import (
+    tiles_from_csv,
+    tile_label_to_file,
+    tile_bbox,
+    tiles_store,
+    tiles_side_path,
+    tiles_stores_close,
+)
+from abd_model.geojson import geojson_srid, geojson_tile_burn, geojson_parse_polygons, geojson_polygons_arrays, FeaturesIndex
 
 
 def add_parser(subparser, formatter_class):
@@ -32,12 +41,14 @@ def add_parser(subparser, formatter_class):
     inp.add_argument("--buffer", type=float, help="Add a Geometrical Buffer around each Features (distance in meter)")
 
     out = parser.add_argument_group("Outputs")
-    out.add_argument("--out", type=str, required=True, help="output directory path [required]")
+    out.add_argument("--out", type=str, required=True, help="output directory path, or mbtiles:// URI [required]")
     out.add_argument("--append", action="store_true", help="Append to existing tile if any, useful to multiclasses labels")
     out.add_argument("--ts", type=str, default="512,512", help="output tile size [default: 512,512]")
 
     perf = parser.add_argument_group("Performances")
     perf.add_argument("--workers", type=int, help="number of workers [default: CPU]")
+    help = "with --sql, send the cover as a temporary table, and stream back features from a single spatial join query"
+    perf.add_argument("--bulk", action="store_true", help=help)
 
     ui = parser.add_argument_group("Web UI")
     ui.add_argument("--web_ui_base_url", type=str, help="alternate Web UI base URL")
@@ -47,22 +58,143 @@ def add_parser(subparser, formatter_class):
     parser.set_defaults(func=main)
 
 
-def worker_spatial_index(zoom, buffer, add_progress, geojson_path):
+def worker_spatial_index(buffer, add_progress, geojson_path):
     geojson = open(os.path.expanduser(geojson_path))
     assert geojson, "Unable to open {}".format(geojson_path)
     fc = json.load(geojson)
     srid = geojson_srid(fc)
 
-    feature_map = collections.defaultdict(list)
+    polygons = []
     if add_progress:
         progress = tqdm(total=len(fc["features"]), ascii=True, unit="feature")
     for feature in fc["features"]:
-        feature_map = geojson_parse_feature(zoom, srid, feature_map, feature, buffer)
+        polygons.extend(geojson_parse_polygons(srid, feature, buffer))
         if add_progress:
             progress.update()
     if add_progress:
         progress.close()
-    return feature_map
+    return geojson_polygons_arrays(polygons)  # compact, and already EPSG:3857, to be pickled back
+
+
+rasterizer = {}  # per worker process state, set once by rasterizer_init
+
+
+def rasterizer_init(args, features_index, srid, palette, transparency, burn_value):
+    rasterizer.update(args=args, features_index=features_index, srid=srid, palette=palette, transparency=transparency)
+    rasterizer.update(burn_value=burn_value, ts=list(map(int, args.ts.split(","))))
+    rasterizer["conn"] = psycopg2.connect(args.pg) if args.sql and not args.bulk else None  # one per worker process
+
+
+def rasterizer_sql_features(tile):
+    """Return a tile features, as EPSG:4326 GeoJSON ones, from the --sql query, or None."""
+
+    args, srid = rasterizer["args"], rasterizer["srid"]
+    w, s, e, n = tile_bbox(tile)
+    tile_geom = "ST_Transform(ST_MakeEnvelope({},{},{},{}, 4326), {})".format(w, s, e, n, srid)
+
+    query = """
+    WITH
+      sql  AS ({}),
+      geom AS (SELECT "1" AS geom FROM sql AS t("1")),
+      json AS (SELECT '{{"type": "Feature", "geometry": '
+             || ST_AsGeoJSON((ST_Dump(ST_Transform(ST_Force2D(geom.geom), 4326))).geom, 6)
+             || '}}' AS features
+            FROM geom)
+    SELECT '{{"type": "FeatureCollection", "features": [' || Array_To_String(array_agg(features), ',') || ']}}'
+    FROM json
+    """.format(
+        args.sql.replace("TILE_GEOM", tile_geom)
+    )
+
+    try:
+        db = rasterizer["conn"].cursor()
+        db.execute(query)
+        row = db.fetchone()
+        return json.loads(row[0])["features"] if row and row[0] else None
+    except Exception:
+        rasterizer["conn"] = psycopg2.connect(args.pg)
+        raise
+
+
+def sql_bulk_features(pg, sql, srid, tiles, itersize=10000):
+    """Yield each cover tile, and its EPSG:4326 GeoJSON features or None, in cover order, from a single query.
+
+    The cover is sent with COPY, as a temporary table, and features are streamed back, grouped by tile, from a named cursor.
+    The --sql query is run as is, per tile, in a LATERAL join, TILE_GEOM being the cover tile geometry, as without --bulk.
+    """
+
+    conn = psycopg2.connect(pg)
+    db = conn.cursor()
+
+    columns = ("i", "x", "y", "z", "w", "s", "e", "n")  # i: cover order
+    table = "i integer, x integer, y integer, z integer, w float8, s float8, e float8, n float8, geom geometry"
+    db.execute("CREATE TEMPORARY TABLE abd_cover ({})".format(table))
+    rows = ["{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\n".format(i, *tile, *tile_bbox(tile)) for i, tile in enumerate(tiles)]
+    db.copy_from(io.StringIO("".join(rows)), "abd_cover", columns=columns)
+    db.execute("UPDATE abd_cover SET geom = ST_Transform(ST_MakeEnvelope(w, s, e, n, 4326), {})".format(int(srid)))
+    db.execute("ANALYZE abd_cover")
+
+    query = """
+    SELECT cover.i, ST_AsGeoJSON((ST_Dump(ST_Transform(ST_Force2D(sql."1"), 4326))).geom, 6)
+    FROM abd_cover AS cover CROSS JOIN LATERAL ({}) AS sql("1")
+    ORDER BY cover.i
+    """.format(
+        sql.replace("TILE_GEOM", "cover.geom")
+    )
+
+    rows = conn.cursor(name="abd_rasterize")  # server side, so features are streamed, by itersize rows
+    rows.itersize = itersize
+    rows.execute(query)
+
+    groups = itertools.groupby(rows, key=lambda row: row[0])
+    group = next(groups, None)
+    for i, tile in enumerate(tiles):  # both in cover order
+        if group is not None and group[0] == i:
+            yield tile, [{"type": "Feature", "geometry": json.loads(row[1])} for row in group[1]]
+            group = next(groups, None)
+        else:
+            yield tile, None
+
+    conn.close()
+
+
+def rasterizer_worker(chunk):
+    """Burn and write a chunk of tiles. Return, in chunk order, tiles, their features number, and invalid geometries flag.
+
+    With --bulk, chunk items are tile and features pairs, already retrieved.
+    """
+
+    args, ts = rasterizer["args"], rasterizer["ts"]
+
+    rows = []
+    for item in chunk:
+
+        tile, geojson = item if args.bulk else (item, None)
+        invalid = False
+
+        if args.sql and not args.bulk:
+            try:
+                geojson = rasterizer_sql_features(tile)
+            except Exception:
+                invalid = True
+
+        if args.geojson:
+            geojson = rasterizer["features_index"].features(tile)
+
+        if geojson:
+            num = len(geojson)
+            features_srid = 3857 if args.geojson else 4326  # FeaturesIndex ones are already reprojected
+            out = geojson_tile_burn(tile, geojson, features_srid, ts, rasterizer["burn_value"])
+
+        if not geojson or out is None:
+            num = 0
+            out = np.zeros(shape=ts, dtype=np.uint8)
+
+        tile_label_to_file(args.out, tile, rasterizer["palette"], rasterizer["transparency"], out, append=args.append)
+        rows.append((tile, num, invalid))
+
+    tiles_stores_close()  # if any, committed now, as pool processes exit without atexit
+    return rows
 
 
 def main(args):
@@ -76,6 +208,7 @@ def main(args):
 
     args.pg = config["auth"]["pg"] if not args.pg and "pg" in config["auth"].keys() else args.pg
     assert not (args.sql and not args.pg), "With --sql option, --pg dsn setting must also be provided"
+    assert not (args.bulk and not args.sql), "--bulk option imply --sql"
 
     palette, transparency = make_palette([classe["color"] for classe in config["classes"]], complementary=True)
     index = [config["classes"].index(classe) for classe in config["classes"] if classe["title"] == args.type]
@@ -86,20 +219,20 @@ def main(args):
     if args.sql:
         assert "limit" not in args.sql.lower(), "LIMIT is not supported"
         assert "TILE_GEOM" in args.sql, "TILE_GEOM filter not found in your SQL"
-        sql = re.sub(r"ST_Intersects( )*\((.*)?TILE_GEOM(.*)?\)", "1=1", args.sql, re.I)
-        assert sql and sql != args.sql, "Incorrect TILE_GEOM filter in your SQL"
+        probe = re.sub(r"ST_Intersects\s*\([^()]*TILE_GEOM[^()]*\)", "TRUE", args.sql, flags=re.I)  # SRID probe only
+        assert "TILE_GEOM" not in probe, "TILE_GEOM is only supported as an ST_Intersects(TILE_GEOM, geom) filter"
 
-    if os.path.dirname(os.path.expanduser(args.out)):
+    if os.path.dirname(os.path.expanduser(args.out)) and tiles_store(args.out) is None:
         os.makedirs(os.path.expanduser(args.out), exist_ok=True)
     args.out = os.path.expanduser(args.out)
-    log = Logs(os.path.join(args.out, "log"), out=sys.stderr)
+    log = Logs(tiles_side_path(args.out, "log"), out=sys.stderr)
 
-    tiles = [tile for tile in tiles_from_csv(os.path.expanduser(args.cover))]
+    tiles = list(dict.fromkeys(tiles_from_csv(os.path.expanduser(args.cover))))  # in cover order, without duplicates
     assert len(tiles), "Empty Cover: {}".format(args.cover)
 
     if args.geojson:
         zoom = tiles[0].z
-        assert not [tile for tile in tiles if tile.z != zoom], "Unsupported zoom mixed cover. Use PostGIS instead"
+        assert all(tile.z == zoom for tile in tiles), "Unsupported zoom mixed cover. Use PostGIS instead"
 
         workers = min(args.workers, len(args.geojson))
         log.log("abd rasterize - Compute spatial index with {} workers".format(workers))
@@ -110,86 +243,68 @@ def main(args):
             progress = tqdm(total=len(args.geojson), ascii=True, unit="file")
             log_from = "{} geojson files".format(len(args.geojson))
 
-        feature_map = collections.defaultdict(list)
+        coords, rings, polygons = [], [], []
         with futures.ProcessPoolExecutor(workers) as executor:
-            for fm in executor.map(
-                partial(worker_spatial_index, zoom, args.buffer, True if progress is None else False), args.geojson
+            for file_coords, file_rings, file_polygons in executor.map(
+                partial(worker_spatial_index, args.buffer, True if progress is None else False), args.geojson
             ):
-                for k, v in fm.items():
-                    try:
-                        feature_map[k] += v
-                    except KeyError:
-                        feature_map[k] = v
+                coords.append(file_coords)
+                rings.append(file_rings)
+                polygons.append(file_polygons)
                 if progress:
                     progress.update()
             if progress:
                 progress.close()
 
+        coords, rings, polygons = np.concatenate(coords), np.concatenate(rings), np.concatenate(polygons)
+        features_index = FeaturesIndex(zoom, coords, rings, polygons)  # each feature stored once, and queried per tile
+
+        if not len(features_index):
+            log.log("-----------------------------------------------")
+            log.log("NOTICE: no feature to rasterize, seems peculiar")
+            log.log("-----------------------------------------------")
+
     if args.sql:
         conn = psycopg2.connect(args.pg)
         db = conn.cursor()
 
-        db.execute("""SELECT ST_Srid("1") AS srid FROM ({} LIMIT 1) AS t("1")""".format(sql))
+        db.execute("""SELECT ST_Srid("1") AS srid FROM ({} LIMIT 1) AS t("1")""".format(probe))
         srid = db.fetchone()[0]
         assert srid and int(srid) > 0, "Unable to retrieve geometry SRID."
+        conn.close()
 
         log_from = args.sql
 
-    if not len(feature_map):
-        log.log("-----------------------------------------------")
-        log.log("NOTICE: no feature to rasterize, seems peculiar")
-        log.log("-----------------------------------------------")
-
     log.log("abd rasterize - rasterizing {} from {} on cover {}".format(args.type, log_from, args.cover))
-    with open(os.path.join(os.path.expanduser(args.out), args.type.lower() + "_cover.csv"), mode="w") as cover:
-
-        for tile in tqdm(tiles, ascii=True, unit="tile"):
-
-            geojson = None
-
-            if args.sql:
-                w, s, e, n = tile_bbox(tile)
-                tile_geom = "ST_Transform(ST_MakeEnvelope({},{},{},{}, 4326), {})".format(w, s, e, n, srid)
-
-                query = """
-                WITH
-                  sql  AS ({}),
-                  geom AS (SELECT "1" AS geom FROM sql AS t("1")),
-                  json AS (SELECT '{{"type": "Feature", "geometry": '
-                         || ST_AsGeoJSON((ST_Dump(ST_Transform(ST_Force2D(geom.geom), 4326))).geom, 6)
-                         || '}}' AS features
-                        FROM geom)
-                SELECT '{{"type": "FeatureCollection", "features": [' || Array_To_String(array_agg(features), ',') || ']}}'
-                FROM json
-                """.format(
-                    args.sql.replace("TILE_GEOM", tile_geom)
-                )
-
-                db.execute(query)
-                row = db.fetchone()
-                try:
-                    geojson = json.loads(row[0])["features"] if row and row[0] else None
-                except Exception:
-                    log.log("Warning: Invalid geometries, skipping {}".format(tile))
-                    conn = psycopg2.connect(args.pg)
-                    db = conn.cursor()
-
-            if args.geojson:
-                geojson = feature_map[tile] if tile in feature_map else None
-
-            if geojson:
-                num = len(geojson)
-                out = geojson_tile_burn(tile, geojson, 4326, list(map(int, args.ts.split(","))), burn_value)
-
-            if not geojson or out is None:
-                num = 0
-                out = np.zeros(shape=list(map(int, args.ts.split(","))), dtype=np.uint8)
-
-            tile_label_to_file(args.out, tile, palette, transparency, out, append=args.append)
-            cover.write("{},{},{}  {}{}".format(tile.x, tile.y, tile.z, num, os.linesep))
-
-    if not args.no_web_ui:
+
+    features_index = features_index if args.geojson else None
+    srid = srid if args.sql else None
+    initargs = (args, features_index, srid, palette, transparency, burn_value)
+
+    items = iter(sql_bulk_features(args.pg, args.sql, srid, tiles) if args.sql and args.bulk else tiles)
+    chunks = iter(lambda: list(itertools.islice(items, 256)), [])  # in cover order, so cover csv is deterministic
+
+    cover_path = tiles_side_path(args.out, args.type.lower() + "_cover.csv")
+    with open(cover_path, mode="w") as cover, tqdm(total=len(tiles), ascii=True, unit="tile") as progress:
+        with futures.ProcessPoolExecutor(args.workers, initializer=rasterizer_init, initargs=initargs) as executor:
+
+            def write(rows):
+                for tile, num, invalid in rows:
+                    if invalid:
+                        log.log("Warning: Invalid geometries, skipping {}".format(tile))
+                    cover.write("{},{},{}  {}{}".format(tile.x, tile.y, tile.z, num, os.linesep))
+                progress.update(len(rows))
+
+            pending = collections.deque()  # bounded, as --bulk chunks are streamed from database
+            for chunk in chunks:
+                pending.append(executor.submit(rasterizer_worker, chunk))
+                if len(pending) > 2 * args.workers:
+                    write(pending.popleft().result())
+
+            while pending:
+                write(pending.popleft().result())
+
+    if not args.no_web_ui and tiles_store(args.out) is None:  # Web UI expects XYZ files
         template = "leaflet.html" if not args.web_ui_template else args.web_ui_template
         base_url = args.web_ui_base_url if args.web_ui_base_url else "."
-        tiles = [tile for tile in tiles_from_csv(args.cover)]
         web_ui(args.out, base_url, tiles, tiles, "png", template)
@@ -1,11 +1,13 @@
 import os
+import io
 import sys
 import shutil
 
 import mercantile
 from tqdm import tqdm
 
-from abd_model.tiles import tiles_from_csv, tile_from_xyz
+from abd_model.tiles import tiles_from_csv, tiles_from_dir, tiles_from_manifest, tile_source, tile_to_file, tiles_store
+from abd_model.tiles import TileIndex
 from abd_model.core import web_ui
 
 
@@ -14,8 +16,9 @@ def add_parser(subparser, formatter_class):
         "subset", help="Filter images in a slippy map dir using a csv tiles cover", formatter_class=formatter_class
     )
     inp = parser.add_argument_group("Inputs")
-    inp.add_argument("--dir", type=str, required=True, help="to XYZ tiles input dir path [required]")
+    inp.add_argument("--dir", type=str, required=True, help="to XYZ tiles input dir path, or mbtiles:// URI [required]")
     inp.add_argument("--cover", type=str, required=True, help="path to csv cover file to filter dir by [required]")
+    inp.add_argument("--manifest", type=str, help="path to abd predict manifest, to only keep non empty masks tiles")
 
     mode = parser.add_argument_group("Alternate modes, as default is to create relative symlinks")
     mode.add_argument("--copy", action="store_true", help="copy tiles from input to output")
@@ -23,7 +26,8 @@ def add_parser(subparser, formatter_class):
 
     out = parser.add_argument_group("Output")
     out.add_argument("--quiet", action="store_true", help="if set, suppress warning output")
-    out.add_argument("--out", type=str, nargs="?", default=os.getcwd(), help="output dir path [required for copy]")
+    help = "output dir path, or mbtiles:// URI [required for copy]"
+    out.add_argument("--out", type=str, nargs="?", default=os.getcwd(), help=help)
 
     ui = parser.add_argument_group("Web UI")
     ui.add_argument("--web_ui_base_url", type=str, help="alternate Web UI base URL")
@@ -40,23 +44,42 @@ def main(args):
     print("abd subset {} with cover {}, on CPU".format(args.dir, args.cover), file=sys.stderr, flush=True)
 
     ext = set()
-    tiles = set(tiles_from_csv(os.path.expanduser(args.cover)))
+    tiles = TileIndex(tiles_from_csv(os.path.expanduser(args.cover)))
     assert len(tiles), "Empty Cover: {}".format(args.cover)
 
+    if args.manifest:
+        non_empty = TileIndex(tiles_from_manifest(os.path.expanduser(args.manifest)))
+        tiles = tiles.select(non_empty.contains(tiles.x, tiles.y, tiles.z))
+
+    paths = TileIndex(tiles_from_dir(args.dir, cover=tiles, xyz_path=True))
+
+    stores = tiles_store(args.dir) is not None or tiles_store(args.out) is not None
+    assert not (stores and args.delete), "--delete is not available with mbtiles:// packed stores"
+
     for tile in tqdm(tiles, ascii=True, unit="tiles"):
 
         if isinstance(tile, mercantile.Tile):
-            src_tile = tile_from_xyz(args.dir, tile.x, tile.y, tile.z)
-            if not src_tile:
+            src = paths.path(tile)
+            if not src:
                 if not args.quiet:
                     print("WARNING: skipping tile {}".format(tile), file=sys.stderr, flush=True)
                 continue
-            _, src = src_tile
             dst_dir = os.path.join(args.out, str(tile.z), str(tile.x))
         else:
             src = tile
             dst_dir = os.path.join(args.out, os.path.dirname(tile))
 
+        if stores:  # encoded tiles are copied, as they can't be linked from, or into, a packed store
+            source, src_ext = tile_source(src)
+            if isinstance(source, io.BytesIO):
+                data = source.getvalue()
+            else:
+                with open(source, "rb") as fp:
+                    data = fp.read()
+            tile_to_file(args.out, tile, data, src_ext)
+            ext.add(src_ext)
+            continue
+
         assert os.path.isfile(src)
         dst = os.path.join(dst_dir, os.path.basename(src))
         ext.add(os.path.splitext(src)[1][1:])
@@ -76,7 +99,7 @@ def main(args):
             os.symlink(os.path.relpath(src, os.path.dirname(dst)), dst)
             assert os.path.islink(dst)
 
-    if tiles and not args.no_web_ui and not args.delete:
+    if tiles and not args.no_web_ui and not args.delete and tiles_store(args.out) is None:  # Web UI expects XYZ files
         assert len(ext) == 1, "ERROR: Mixed extensions, can't generate Web UI"
         template = "leaflet.html" if not args.web_ui_template else args.web_ui_template
         base_url = args.web_ui_base_url if args.web_ui_base_url else "."
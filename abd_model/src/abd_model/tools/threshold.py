@@ -0,0 +1,75 @@
+import os
+import sys
+from tqdm import tqdm
+import concurrent.futures as futures
+
+from abd_model.core import load_config, check_classes, make_palette, web_ui, Logs
+from abd_model.tiles import tiles_from_dir, tiles_from_csv, tile_image_from_file, tile_label_to_file, tile_probs_to_label
+
+
+def add_parser(subparser, formatter_class):
+    help = "Generate masks from quantized classes scores, stored by abd predict"
+    parser = subparser.add_parser("threshold", help=help, formatter_class=formatter_class)
+
+    inp = parser.add_argument_group("Inputs")
+    help = "quantized classes scores directory path, from abd predict [required]"
+    inp.add_argument("--probs", type=str, required=True, help=help)
+    inp.add_argument("--config", type=str, help="path to config file [required, if no global config setting]")
+    inp.add_argument("--cover", type=str, help="path to csv tiles cover file, to filter tiles on [optional]")
+    help = "classes scores threshold, in ]0,1[, a class is kept above [default: 0.5, as predict masks]"
+    inp.add_argument("--threshold", type=float, default=0.5, help=help)
+
+    out = parser.add_argument_group("Outputs")
+    out.add_argument("--out", type=str, required=True, help="output directory path [required]")
+    help = "masks PNG compression level, from 0 (none) to 9 (max) [default: 6]"
+    out.add_argument("--compress_level", type=int, default=6, choices=range(0, 10), metavar="[0-9]", help=help)
+
+    perf = parser.add_argument_group("Performances")
+    perf.add_argument("--workers", type=int, help="number of workers [default: CPU]")
+
+    ui = parser.add_argument_group("Web UI")
+    ui.add_argument("--web_ui_base_url", type=str, help="alternate Web UI base URL")
+    ui.add_argument("--web_ui_template", type=str, help="alternate Web UI template path")
+    ui.add_argument("--no_web_ui", action="store_true", help="desactivate Web UI output")
+
+    parser.set_defaults(func=main)
+
+
+def main(args):
+    config = load_config(args.config)
+    check_classes(config)
+    assert 0.0 < args.threshold < 1.0, "--threshold expects a value in ]0,1["
+
+    palette, transparency = make_palette([classe["color"] for classe in config["classes"]])
+    cover = [tile for tile in tiles_from_csv(os.path.expanduser(args.cover))] if args.cover else None
+    args.workers = args.workers if args.workers else os.cpu_count()
+
+    tiles = list(tiles_from_dir(args.probs, cover=cover, xyz_path=True))
+    assert len(tiles), "Empty classes scores directory: {}".format(args.probs)
+
+    args.out = os.path.expanduser(args.out)
+    log = Logs(os.path.join(args.out, "log"), out=sys.stderr)
+    log.log("abd threshold {} at {}, on CPU with {} workers".format(args.probs, args.threshold, args.workers))
+
+    progress = tqdm(total=len(tiles), ascii=True, unit="tile")
+    with futures.ThreadPoolExecutor(args.workers) as executor:
+
+        def worker(tile_path):
+            tile, path = tile_path
+
+            probs = tile_image_from_file(path)
+            assert probs is not None, "Unable to open {}".format(path)
+            assert probs.shape[2] == len(config["classes"]), "Classes scores and config classes mismatch: {}".format(path)
+
+            mask = tile_probs_to_label(probs, args.threshold)
+            tile_label_to_file(args.out, tile, palette, transparency, mask, compress_level=args.compress_level)
+            progress.update()
+
+            return tile
+
+        tiles = [tile for tile in executor.map(worker, tiles)]
+
+    if not args.no_web_ui:
+        template = "leaflet.html" if not args.web_ui_template else args.web_ui_template
+        base_url = args.web_ui_base_url if args.web_ui_base_url else "."
+        web_ui(args.out, base_url, tiles, tiles, "png", template)
@@ -1,27 +1,33 @@
 import os
 import sys
+import math
+import collections
 from tqdm import tqdm
 import concurrent.futures as futures
 
 import numpy as np
 
-import shutil
 import mercantile
 
 from rasterio import open as rasterio_open
 from rasterio.vrt import WarpedVRT
 from rasterio.enums import Resampling
-from rasterio.warp import transform_bounds
-from rasterio.transform import from_bounds
+from rasterio.warp import transform, transform_bounds
+from rasterio.windows import Window
+from rasterio.transform import from_origin
 
 from abd_model.core import load_config, check_classes, make_palette, web_ui, Logs
 from abd_model.tiles import (
     tiles_from_csv,
-    tile_from_xyz,
-    tile_image_to_file,
-    tile_label_to_file,
+    tiles_store,
+    tiles_store_path,
+    tiles_side_path,
+    tiles_stores_close,
+    TileIndex,
     tile_image_from_file,
+    tile_image_to_file,
     tile_label_from_file,
+    tile_label_to_file,
 )
 
 
@@ -32,9 +38,14 @@ def add_parser(subparser, formatter_class):
     inp.add_argument("--rasters", type=str, required=True, nargs="+", help="path to raster files to tile [required]")
     inp.add_argument("--cover", type=str, help="path to csv tiles cover file, to filter tiles to tile [optional]")
     inp.add_argument("--bands", type=str, help="list of 1-n index bands to select (e.g 1,2,3) [optional]")
+    choices = ["first", "last", "least-nodata"]
+    help = "on overlapping rasters, the one whose pixels are kept first, as listed, or with least nodata [default: first]"
+    inp.add_argument("--priority", type=str, default="first", choices=choices, help=help)
 
     out = parser.add_argument_group("Output")
-    out.add_argument("--zoom", type=int, required=True, help="zoom level of tiles [required]")
+    out.add_argument("--zoom", type=int, help="zoom level of tiles [required, if no --zooms]")
+    help = "zoom levels range, the lower ones being built by 2x2 downsampling of the highest (e.g 15-18) [optional]"
+    out.add_argument("--zooms", type=str, help=help)
     out.add_argument("--ts", type=str, default="512,512", help="tile size in pixels [default: 512,512]")
     help = "nodata pixel value, used by default to remove coverage border's tile [default: 0]"
     out.add_argument("--nodata", type=int, default=0, choices=range(0, 256), metavar="[0-255]", help=help)
@@ -42,14 +53,14 @@ def add_parser(subparser, formatter_class):
     out.add_argument("--nodata_threshold", type=int, default=100, choices=range(0, 101), metavar="[0-100]", help=help)
     out.add_argument("--keep_borders", action="store_true", help="keep tiles even if borders are empty (nodata)")
     out.add_argument("--format", type=str, help="file format to save images in (e.g jpeg)")
-    out.add_argument("--out", type=str, required=True, help="output directory path [required]")
+    out.add_argument("--out", type=str, required=True, help="output directory path, or mbtiles:// URI [required]")
 
     lab = parser.add_argument_group("Labels")
     lab.add_argument("--label", action="store_true", help="if set, generate label tiles")
     lab.add_argument("--config", type=str, help="path to config file [required with --label, if no global config setting]")
 
     perf = parser.add_argument_group("Performances")
-    perf.add_argument("--workers", type=int, help="number of workers [default: raster files]")
+    perf.add_argument("--workers", type=int, help="number of workers [default: CPU]")
 
     ui = parser.add_argument_group("Web UI")
     ui.add_argument("--web_ui_base_url", type=str, help="alternate Web UI base URL")
@@ -73,6 +84,221 @@ def is_nodata(image, nodata, threshold, keep_borders=False):
     return np.sum(image[:, :, :] == nodata) >= C * W * H * (threshold / 100)
 
 
+def tiles_runs(tiles, run):
+    """Group tiles by runs of consecutive tiles, on a same tiles row, each of up to run tiles."""
+
+    runs = []
+    for tile in sorted(tiles, key=lambda tile: (tile.y, tile.x)):
+        if runs and len(runs[-1]) < run and runs[-1][-1].y == tile.y and runs[-1][-1].x == tile.x - 1:
+            runs[-1].append(tile)
+        else:
+            runs.append([tile])
+
+    return runs
+
+
+def to_uint8(data):
+    """Rescale 16 or 32 bits raster data to 8 bits, as tiles are written, and nodata compared."""
+
+    if data.dtype == "uint16":  # GeoTiff could be 16 bits
+        return np.uint8(data / 256)
+    if data.dtype == "uint32":  # or 32 bits
+        return np.uint8(data / (256 * 256))
+
+    return data
+
+
+class RasterTiles:
+    def __init__(self, path, extent, width, height):
+        """Open a raster through a single EPSG:3857 WarpedVRT, aligned on the x0,y0,x1,y1,z tiles extent grid."""
+
+        x0, y0, x1, y1, z = extent
+        w, s, e, n = mercantile.xy_bounds(mercantile.Tile(x=x0, y=y0, z=z))
+
+        self.x0, self.y0, self.width, self.height = x0, y0, width, height
+        self.raster = rasterio_open(os.path.expanduser(path))
+        self.warp_vrt = WarpedVRT(
+            self.raster,
+            crs="epsg:3857",
+            resampling=Resampling.bilinear,
+            add_alpha=False,
+            transform=from_origin(w, n, (e - w) / width, (n - s) / height),
+            width=(x1 - x0 + 1) * width,
+            height=(y1 - y0 + 1) * height,
+        )
+
+    def read(self, tiles_run, bands):
+        """Read a run of consecutive tiles, on a same tiles row, in a single window. Return a H,W,C images list."""
+
+        col, row = (tiles_run[0].x - self.x0) * self.width, (tiles_run[0].y - self.y0) * self.height
+        data = self.warp_vrt.read(indexes=bands, window=Window(col, row, len(tiles_run) * self.width, self.height))
+        data = np.moveaxis(to_uint8(data), 0, 2)  # C,H,W -> H,W,C
+        return [data[:, i * self.width : (i + 1) * self.width, :] for i in range(len(tiles_run))]
+
+    def close(self):
+        self.warp_vrt.close()
+        self.raster.close()
+
+
+def mosaic(images, nodata, priority="first"):
+    """Composite overlapping H,W,C images: pixels nodata on all bands are filled from next images, in priority order."""
+
+    if len(images) == 1:
+        return images[0]
+
+    if priority == "last":
+        images = images[::-1]
+    if priority == "least-nodata":
+        images = sorted(images, key=lambda image: np.sum(np.all(image == nodata, axis=2)))
+
+    image = images[0].copy()
+    for source in images[1:]:
+        holes = np.all(image == nodata, axis=2)
+        if not holes.any():
+            break
+        image[holes] = source[holes]
+
+    return image
+
+
+def raster_valid_tiles(raster, tiles, bands, nodata, size=1024):
+    """Return a boolean array, False for tiles lying entirely in raster nodata, or None if no cheap coarse mask.
+
+    The coarse validity mask, up to size pixels wide, is read from overviews (or from small enough rasters), and compares
+    pixels to --nodata once rescaled to 8 bits, as tiles reads do. Tiles windows are widened by one coarse pixel, to only
+    drop tiles conservatively. With a 0 nodata, coarse pixels are their blocks max, so none valid pixel is ever missed.
+    """
+
+    if not raster.overviews(bands[0]) and raster.width * raster.height > 16 * size * size:
+        return None  # a decimated read would be a full resolution one
+
+    decimation = max(1, math.ceil(max(raster.width, raster.height) / size))
+    h, w = math.ceil(raster.height / decimation), math.ceil(raster.width / decimation)
+    resampling = Resampling.max if nodata == 0 else Resampling.nearest
+    data = to_uint8(raster.read(bands, out_shape=(len(bands), h, w), resampling=resampling))
+    valid = ~np.all(data == nodata, axis=0)
+    integral = np.pad(valid.astype(np.int64).cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+
+    z, extent = tiles[0].z, 2 * 20037508.342789244  # EPSG:3857 world width, in meters
+    xs, ys = np.array([tile.x for tile in tiles]), np.array([tile.y for tile in tiles])
+    X = np.concatenate([(xs + dx) * extent / (1 << z) - extent / 2 for dx in (0, 1, 0, 1)])  # tiles 4 corners
+    Y = np.concatenate([extent / 2 - (ys + dy) * extent / (1 << z) for dy in (0, 0, 1, 1)])
+    X, Y = transform("EPSG:3857", raster.crs, X.tolist(), Y.tolist())
+    coarse = raster.transform * raster.transform.scale(raster.width / w, raster.height / h)
+    cols, rows = ~coarse * (np.array(X), np.array(Y))
+    cols, rows = cols.reshape(4, -1), rows.reshape(4, -1)
+
+    c0 = np.clip(np.floor(cols.min(axis=0)).astype(np.int64) - 1, 0, w)
+    c1 = np.clip(np.ceil(cols.max(axis=0)).astype(np.int64) + 1, 0, w)
+    r0 = np.clip(np.floor(rows.min(axis=0)).astype(np.int64) - 1, 0, h)
+    r1 = np.clip(np.ceil(rows.max(axis=0)).astype(np.int64) + 1, 0, h)
+
+    return (integral[r1, c1] - integral[r0, c1] - integral[r1, c0] + integral[r0, c0]) > 0
+
+
+tiler = {}  # per worker process state, set once by tiler_init
+
+
+def tiler_init(args, extents, width, height, palette, ext):
+    tiler.update(args=args, extents=extents, width=width, height=height, palette=palette, ext=ext)
+    tiler["handles"] = collections.OrderedDict()  # least recently used bounded, raster handles
+
+
+def tiler_worker(unit):
+    """Tile a work unit: a run of tiles, mosaicked from their overlapping rasters. Return written tiles, and run length."""
+
+    args, palette, ext = tiler["args"], tiler["palette"], tiler["ext"]
+    paths, tiles_run = unit
+
+    sources = []
+    handles = tiler["handles"]
+    for path in paths:
+        if path not in handles:
+            if len(handles) >= 16:
+                handles.popitem(last=False)[1].close()
+            handles[path] = RasterTiles(path, tiler["extents"][path], tiler["width"], tiler["height"])
+        handles.move_to_end(path)
+        sources.append(handles[path].read(tiles_run, args.bands))
+
+    tiled = []
+    for i, tile in enumerate(tiles_run):
+        image = mosaic([source[i] for source in sources], args.nodata, args.priority)
+
+        if not args.label and is_nodata(image, args.nodata, args.nodata_threshold, args.keep_borders):
+            continue
+
+        if not args.label:
+            tile_image_to_file(args.out, tile, image, ext=ext)
+        if args.label:
+            tile_label_to_file(args.out, tile, palette, args.nodata, image)
+
+        tiled.append(tile)
+
+    tiles_stores_close()  # if any, committed now, as pool processes exit without atexit
+    return tiled, len(tiles_run)
+
+
+def downsample(image, nodata, label=False):
+    """Downsample a 2H,2W,C image to H,W,C: averaging each 2x2 pixels block but nodata pixels, or nearest for labels."""
+
+    if label:
+        return image[::2, ::2, :]
+
+    H, W, C = image.shape
+    blocks = image.reshape(H // 2, 2, W // 2, 2, C).astype(np.float32)
+    valid = ~np.all(blocks == nodata, axis=4, keepdims=True)
+    count = valid.sum(axis=(1, 3))
+    mean = (blocks * valid).sum(axis=(1, 3)) / np.maximum(count, 1)
+
+    return np.where(count > 0, np.round(mean), nodata).astype(image.dtype)
+
+
+def pyramid_worker(parents):
+    """Build parents tiles, each one from its 4 already written children. Return written tiles, and parents length."""
+
+    args, palette, ext = tiler["args"], tiler["palette"], tiler["ext"]
+    width, height = tiler["width"], tiler["height"]
+    store = tiles_store(args.out) is not None
+
+    tiled = []
+    for tile in parents:
+        image = None
+        for child in mercantile.children(tile):
+            if store:
+                path = tiles_store_path(args.out, child)
+            else:
+                path = os.path.join(args.out, str(child.z), str(child.x), "{}.{}".format(child.y, ext))
+                if not os.path.isfile(path):
+                    continue
+
+            child_image = tile_label_from_file(path) if args.label else tile_image_from_file(path)
+            if child_image is None:
+                continue
+            child_image = child_image.reshape(height, width, -1)
+
+            if image is None:
+                image = np.full((2 * height, 2 * width, child_image.shape[2]), args.nodata, dtype=np.uint8)
+            row, col = (child.y - 2 * tile.y) * height, (child.x - 2 * tile.x) * width
+            image[row : row + height, col : col + width, :] = child_image
+
+        if image is None:
+            continue
+
+        image = downsample(image, args.nodata, args.label)
+        if not args.label and is_nodata(image, args.nodata, args.nodata_threshold, args.keep_borders):
+            continue
+
+        if not args.label:
+            tile_image_to_file(args.out, tile, image, ext=ext)
+        if args.label:
+            tile_label_to_file(args.out, tile, palette, args.nodata, image)
+
+        tiled.append(tile)
+
+    tiles_stores_close()  # if any, committed now, as pool processes exit without atexit
+    return tiled, len(parents)
+
+
 def main(args):
 
     assert not (args.label and args.format), "Format option not supported for label, output must be kept as png"
@@ -82,7 +308,15 @@ def main(args):
         raise ValueError("invalid --args.bands value")
 
     if not args.workers:
-        args.workers = min(os.cpu_count(), len(args.rasters))
+        args.workers = os.cpu_count()
+
+    assert args.zoom is not None or args.zooms, "Either --zoom or --zooms is mandatory"
+    try:
+        zooms = list(map(int, args.zooms.split("-"))) if args.zooms else [args.zoom, args.zoom]
+        assert len(zooms) == 2 and 0 <= zooms[0] <= zooms[1]
+    except:
+        raise ValueError("invalid --zooms value, expected a zoom levels range (e.g 15-18)")
+    args.zoom = zooms[1]  # highest one, tiled from rasters
 
     if args.label:
         config = load_config(args.config)
@@ -93,14 +327,12 @@ def main(args):
     assert len(args.ts.split(",")) == 2, "--ts expect width,height value (e.g 512,512)"
     width, height = list(map(int, args.ts.split(",")))
 
-    cover = [tile for tile in tiles_from_csv(os.path.expanduser(args.cover))] if args.cover else None
-
-    splits_path = os.path.join(os.path.expanduser(args.out), ".splits")
+    cover = TileIndex(tiles_from_csv(os.path.expanduser(args.cover))) if args.cover else None
 
     args.out = os.path.expanduser(args.out)
-    if os.path.dirname(os.path.expanduser(args.out)):
+    if os.path.dirname(os.path.expanduser(args.out)) and tiles_store(args.out) is None:
         os.makedirs(args.out, exist_ok=True)
-    log = Logs(os.path.join(args.out, "log"), out=sys.stderr)
+    log = Logs(tiles_side_path(args.out, "log"), out=sys.stderr)
 
     raster = rasterio_open(os.path.expanduser(args.rasters[0]))
     args.bands = args.bands if args.bands else raster.indexes
@@ -111,9 +343,9 @@ def main(args):
         flush=True,
     )
 
-    skip = []
-    tiles_map = {}
-    total = 0
+    tiles_map = {}  # tile -> overlapping rasters paths, as listed
+    extents = {}  # raster path -> x0,y0,x1,y1,z tiles extent
+    screened = 0
     for path in args.rasters:
         raster = rasterio_open(os.path.expanduser(path))
         assert set(args.bands).issubset(set(raster.indexes)), "Missing bands in raster {}".format(path)
@@ -122,21 +354,30 @@ def main(args):
             w, s, e, n = transform_bounds(raster.crs, "EPSG:4326", *raster.bounds)
         except:
             log.log("WARNING: missing or invalid raster projection, SKIPPING: {}".format(path))
-            skip.append(path)
+            raster.close()
             continue
 
         tiles = [mercantile.Tile(x=x, y=y, z=z) for x, y, z in mercantile.tiles(w, s, e, n, args.zoom)]
-        tiles = list(set(tiles) & set(cover)) if cover else tiles
-        total += len(tiles)
+        if cover and tiles:  # candidates encoded once, and filtered in a single vectorized lookup
+            x, y, z = np.array(tiles, dtype=np.int64).T
+            tiles = [tile for tile, keep in zip(tiles, cover.contains(x, y, z).tolist()) if keep]
 
-        for tile in tiles:
-            tile_key = (str(tile.x), str(tile.y), str(tile.z))
-            if tile_key not in tiles_map.keys():
-                tiles_map[tile_key] = []
-            tiles_map[tile_key].append(path)
+        valid = raster_valid_tiles(raster, tiles, args.bands, args.nodata) if tiles and not args.label else None
+        if valid is not None:  # tiles entirely in nodata, dropped before any full resolution read
+            screened += len(tiles) - int(valid.sum())
+            tiles = [tile for tile, keep in zip(tiles, valid.tolist()) if keep]
 
         raster.close()
-    assert total, "Nothing left to tile"
+        if not tiles:
+            continue
+
+        xs, ys = [tile.x for tile in tiles], [tile.y for tile in tiles]
+        extents[path] = (min(xs), min(ys), max(xs), max(ys), args.zoom)
+        for tile in tiles:
+            tiles_map.setdefault(tile, []).append(path)
+    assert len(tiles_map), "Nothing left to tile"
+    if screened:
+        log.log("Pre-screening: {} rasters tiles skipped, as entirely nodata".format(screened))
 
     if len(args.bands) == 1 or args.label:
         ext = "png" if args.format is None else args.format
@@ -145,130 +386,33 @@ def main(args):
     if len(args.bands) > 3:
         ext = "tiff" if args.format is None else args.format
 
-    tiles = []
-    progress = tqdm(desc="Coverage tiling", total=total, ascii=True, unit="tile")
-    with futures.ThreadPoolExecutor(args.workers) as executor:
-
-        def worker(path):
-
-            if path in skip:
-                return None
-
-            raster = rasterio_open(path)
-            w, s, e, n = transform_bounds(raster.crs, "EPSG:4326", *raster.bounds)
-            tiles = [mercantile.Tile(x=x, y=y, z=z) for x, y, z in mercantile.tiles(w, s, e, n, args.zoom)]
-            tiled = []
-
-            for tile in tiles:
-
-                if cover and tile not in cover:
-                    continue
-
-                w, s, e, n = mercantile.xy_bounds(tile)
-
-                warp_vrt = WarpedVRT(
-                    raster,
-                    crs="epsg:3857",
-                    resampling=Resampling.bilinear,
-                    add_alpha=False,
-                    transform=from_bounds(w, s, e, n, width, height),
-                    width=width,
-                    height=height,
-                )
-
-                data = warp_vrt.read(
-                    out_shape=(len(args.bands), width, height), indexes=args.bands, window=warp_vrt.window(w, s, e, n)
-                )
-                if data.dtype == "uint16":  # GeoTiff could be 16 bits
-                    data = np.uint8(data / 256)
-                elif data.dtype == "uint32":  # or 32 bits
-                    data = np.uint8(data / (256 * 256))
-
-                image = np.moveaxis(data, 0, 2)  # C,H,W -> H,W,C
-
-                tile_key = (str(tile.x), str(tile.y), str(tile.z))
-                if (
-                    not args.label
-                    and len(tiles_map[tile_key]) == 1
-                    and is_nodata(image, args.nodata, args.nodata_threshold, args.keep_borders)
-                ):
-                    progress.update()
-                    continue
-
-                if len(tiles_map[tile_key]) > 1:
-                    out = os.path.join(splits_path, str(tiles_map[tile_key].index(path)))
-                else:
-                    out = args.out
-
-                x, y, z = map(int, tile)
-
-                if not args.label:
-                    tile_image_to_file(out, mercantile.Tile(x=x, y=y, z=z), image, ext=ext)
-                if args.label:
-                    tile_label_to_file(out, mercantile.Tile(x=x, y=y, z=z), palette, args.nodata, image)
-
-                if len(tiles_map[tile_key]) == 1:
-                    tiled.append(mercantile.Tile(x=x, y=y, z=z))
-
-                progress.update()
-
-            raster.close()
-            return tiled
-
-        for tiled in executor.map(worker, args.rasters):
-            if tiled is not None:
-                tiles.extend(tiled)
-
-    total = sum([1 for tile_key in tiles_map.keys() if len(tiles_map[tile_key]) > 1])
-    progress = tqdm(desc="Aggregate splits", total=total, ascii=True, unit="tile")
-    with futures.ThreadPoolExecutor(args.workers) as executor:
-
-        def worker(tile_key):
-
-            if len(tiles_map[tile_key]) == 1:
-                return
+    units = {}  # overlapping rasters -> their tiles, so each tile is mosaicked in memory, and written once
+    for tile, paths in tiles_map.items():
+        units.setdefault(tuple(paths), []).append(tile)
+    units = [(paths, tiles_run) for paths, tiles in units.items() for tiles_run in tiles_runs(tiles, 32)]
 
-            image = np.zeros((width, height, len(args.bands)), np.uint8)
-
-            x, y, z = map(int, tile_key)
-            for i in range(len(tiles_map[tile_key])):
-                root = os.path.join(splits_path, str(i))
-                _, path = tile_from_xyz(root, x, y, z)
-
-                if not args.label:
-                    split = tile_image_from_file(path)
-                if args.label:
-                    split = tile_label_from_file(path)
-
-                if len(split.shape) == 2:
-                    split = split.reshape((width, height, 1))  # H,W -> H,W,C
-
-                assert image.shape == split.shape, "{}, {}".format(image.shape, split.shape)
-                image[np.where(image == 0)] += split[np.where(image == 0)]
-
-            if not args.label and is_nodata(image, args.nodata, args.nodata_threshold, args.keep_borders):
-                progress.update()
-                return
-
-            tile = mercantile.Tile(x=x, y=y, z=z)
-
-            if not args.label:
-                tile_image_to_file(args.out, tile, image)
-
-            if args.label:
-                tile_label_to_file(args.out, tile, palette, image)
-
-            progress.update()
-            return tile
-
-        for tiled in executor.map(worker, tiles_map.keys()):
-            if tiled is not None:
-                tiles.append(tiled)
-
-        if splits_path and os.path.isdir(splits_path):
-            shutil.rmtree(splits_path)  # Delete suffixes dir if any
-
-    if tiles and not args.no_web_ui:
+    tiles = []
+    progress = tqdm(desc="Coverage tiling", total=len(tiles_map), ascii=True, unit="tile")
+    initargs = (args, extents, width, height, palette if args.label else None, ext)
+    with futures.ProcessPoolExecutor(args.workers, initializer=tiler_init, initargs=initargs) as executor:
+
+        for future in futures.as_completed([executor.submit(tiler_worker, unit) for unit in units]):
+            tiled, done = future.result()
+            tiles.extend(tiled)
+            progress.update(done)
+
+        children = tiles
+        for zoom in range(zooms[1] - 1, zooms[0] - 1, -1):  # level by level, each one from the previous one
+            parents = tiles_runs({mercantile.parent(tile) for tile in children}, 64)
+            progress = tqdm(desc="Pyramid zoom {}".format(zoom), total=sum(map(len, parents)), ascii=True, unit="tile")
+
+            children = []
+            for future in futures.as_completed([executor.submit(pyramid_worker, run) for run in parents]):
+                tiled, done = future.result()
+                children.extend(tiled)
+                progress.update(done)
+
+    if tiles and not args.no_web_ui and tiles_store(args.out) is None:  # Web UI expects XYZ files
         template = "leaflet.html" if not args.web_ui_template else args.web_ui_template
         base_url = args.web_ui_base_url if args.web_ui_base_url else "."
         web_ui(args.out, base_url, tiles, tiles, ext, template)
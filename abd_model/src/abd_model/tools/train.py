@@ -14,6 +14,7 @@ from torch.nn.parallel import DistributedDataParallel
 
 import abd_model as abd
 from abd_model.core import load_config, load_module, check_model, check_channels, check_classes, Logs
+from abd_model.autotune import autotune
 from abd_model.tiles import tiles_from_csv
 from abd_model.tools.dataset import compute_classes_weights
 
@@ -43,6 +44,8 @@ def add_parser(subparser, formatter_class):
     mt.add_argument("--resume", action="store_true", help="resume model training, if set imply to provide a checkpoint")
     mt.add_argument("--checkpoint", type=str, help="path to a model checkpoint. To fine tune or resume a training")
     mt.add_argument("--workers", type=int, help="number of pre-processing images workers, per GPU [default: batch size]")
+    help = "if set, probe batch sizes and workers on the dataset, and use the fastest ones (overrides --bs --workers)"
+    mt.add_argument("--autotune", action="store_true", help=help)
 
     out = parser.add_argument_group("Output")
     out.add_argument("--saving", type=int, default=1, help="number of epochs beetwen checkpoint saving [default: 1]")
@@ -105,6 +108,10 @@ def main(args):
     if args.classes_weights == "auto":
         args.classes_weights = compute_classes_weights(args.dataset, config["classes"], args.cover, os.cpu_count())
 
+    if args.autotune:
+        config["train"]["bs"], args.workers = autotune_train(args, config, dataset, world_size, log)
+        torch.cuda.empty_cache()
+
     log.log("\n--- Input tensor")
     num_channel = 1  # 1-based numerotation
     for channel in config["channels"]:
@@ -128,6 +135,39 @@ def main(args):
         os.remove(lock_file)
 
 
+def autotune_train(args, config, dataset, world_size, log):
+    """Probe, in a single process, on first GPU, train batch sizes and workers, and return the fastest ones."""
+
+    device = torch.device("cuda:0")
+
+    nn_module = load_module("abd_model.nn.{}".format(config["model"]["nn"].lower()))
+    nn = getattr(nn_module, config["model"]["nn"])(
+        dataset.shape_in, dataset.shape_out, config["model"]["encoder"].lower(), config["train"]
+    ).to(device)
+
+    optimizer_params = {key: value for key, value in config["train"]["optimizer"].items() if key != "name"}
+    optimizer = getattr(torch.optim, config["train"]["optimizer"]["name"])(nn.parameters(), **optimizer_params)
+
+    loss_module = load_module("abd_model.losses.{}".format(config["train"]["loss"].lower()))
+    criterion = getattr(loss_module, config["train"]["loss"])().to(device)
+
+    def step(batch, bs):
+        images, masks, tiles, tiles_weights = batch
+        outputs = nn(images.to(device, non_blocking=True))
+        loss = criterion(outputs, masks.to(device, non_blocking=True), args.classes_weights, tiles_weights, config)
+
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+
+        return int(images.size(0))
+
+    nn.train()
+    bs, workers = autotune(dataset, step, device, 64, math.floor(os.cpu_count() / world_size), log)
+
+    return bs, workers  # probed model and optimizer are released on return
+
+
 def gpu_worker(rank, world_size, lock_file, dataset, shape_in, shape_out, args, config):
 
     log = Logs(os.path.join(args.out, "log")) if rank == 0 else None
@@ -11,16 +11,17 @@ import rasterio.features
 import rasterio.transform
 
 from abd_model.core import load_config, check_classes
-from abd_model.tiles import tiles_from_dir
+from abd_model.tiles import tiles_from_dir, tiles_from_manifest, tiles_store, tiles_store_path, tile_source
 
 
 def add_parser(subparser, formatter_class):
     parser = subparser.add_parser("vectorize", help="Extract GeoJSON from tiles masks", formatter_class=formatter_class)
 
     inp = parser.add_argument_group("Inputs")
-    inp.add_argument("--masks", type=str, required=True, help="input masks directory path [required]")
+    inp.add_argument("--masks", type=str, required=True, help="input masks directory path, or mbtiles:// URI [required]")
     inp.add_argument("--type", type=str, required=True, help="type of features to extract (i.e class title) [required]")
     inp.add_argument("--config", type=str, help="path to config file [required, if no global config setting]")
+    inp.add_argument("--manifest", type=str, help="path to abd predict manifest, to only vectorize non empty masks")
 
     out = parser.add_argument_group("Outputs")
     out.add_argument("--out", type=str, required=True, help="path to output file to store features in [required]")
@@ -34,7 +35,15 @@ def main(args):
     index = [i for i in (list(range(len(config["classes"])))) if config["classes"][i]["title"] == args.type]
     assert index, "Requested type {} not found among classes title in the config file.".format(args.type)
 
-    masks = list(tiles_from_dir(args.masks, xyz_path=True))
+    if args.manifest:  # no need to scan masks dir, nor to open empty masks
+        root = os.path.expanduser(args.masks)
+        tiles = sorted(set(tiles_from_manifest(os.path.expanduser(args.manifest))))
+        if tiles_store(args.masks) is not None:
+            masks = [(tile, tiles_store_path(args.masks, tile)) for tile in tiles]
+        else:
+            masks = [(tile, os.path.join(root, str(tile.z), str(tile.x), "{}.png".format(tile.y))) for tile in tiles]
+    else:
+        masks = list(tiles_from_dir(args.masks, xyz_path=True))
     assert len(masks), "empty masks directory: {}".format(args.masks)
 
     print("abd vectorize {} from {}".format(args.type, args.masks), file=sys.stderr, flush=True)
@@ -48,12 +57,12 @@ def main(args):
 
     first = True
     for tile, path in tqdm(masks, ascii=True, unit="mask"):
-        mask = (np.array(Image.open(path).convert("P"), dtype=np.uint8) == index).astype(np.uint8)
+        mask = (np.array(Image.open(tile_source(path)[0]).convert("P"), dtype=np.uint8) == index).astype(np.uint8)
         try:
             C, W, H = mask.shape
         except:
             W, H = mask.shape
-        transform = rasterio.transform.from_bounds((*mercantile.bounds(tile.x, tile.y, tile.z)), W, H)
+        transform = rasterio.transform.from_bounds(*mercantile.bounds(tile.x, tile.y, tile.z), W, H)
 
         for shape, value in rasterio.features.shapes(mask, transform=transform, mask=mask):
             geom = '"geometry":{{"type": "Polygon", "coordinates":{}}}'.format(json.dumps(shape["coordinates"]))
@@ -0,0 +1,45 @@
+import random
+
+import mercantile
+import numpy as np
+from shapely.geometry import Polygon, box
+
+from abd_model.geojson import FeaturesIndex, geojson_polygon_tiles, geojson_polygons_arrays
+
+
+def random_polygons(n, seed=0):
+    """EPSG:4326 GeoJSON Polygons, from sub tile to multi tiles wide, at z17, around Paris."""
+
+    rng = random.Random(seed)
+    polygons = []
+    for _ in range(n):
+        lon, lat, radius = 2.30 + rng.random() * 0.02, 48.85 + rng.random() * 0.02, rng.choice([0.00005, 0.0003, 0.002])
+        angles = sorted(rng.random() * 2 * np.pi for _ in range(rng.randint(3, 9)))
+        scales = [(radius * rng.uniform(0.5, 1), radius * rng.uniform(0.5, 1)) for _ in angles]
+        ring = [[lon + sx * np.cos(a), lat + sy * np.sin(a)] for a, (sx, sy) in zip(angles, scales)]
+        polygons.append({"type": "Polygon", "coordinates": [ring + [ring[0]]]})
+
+    return polygons
+
+
+def test_features_index_as_burntiles():
+    polygons = random_polygons(300)
+    index = FeaturesIndex(17, *geojson_polygons_arrays(polygons), cache=16)
+
+    burnt = {}  # baseline rasterize: tile -> polygons, from each polygon burntiles
+    for i, polygon in enumerate(polygons):
+        for tile in geojson_polygon_tiles(17, polygon):
+            burnt.setdefault(mercantile.Tile(*map(int, tile)), set()).add(i)
+    assert len(burnt) > 100
+
+    tiles = set(burnt) | set(mercantile.tiles(2.2995, 48.8495, 2.3225, 48.8725, 17))  # and empty ones around
+    for tile in tiles:
+        queried = set(index.query(tile).tolist())
+        assert burnt.get(tile, set()) <= queried, tile
+
+        tile_box = box(*mercantile.bounds(tile))
+        for i in queried - burnt.get(tile, set()):  # only slivers, burntiles raster burn misses
+            assert Polygon(*polygons[i]["coordinates"]).intersection(tile_box).area < tile_box.area * 0.001, (tile, i)
+
+        assert len(index.features(tile)) == len(queried)
+        assert len(index.shapes) <= 16  # bounded shapes cache
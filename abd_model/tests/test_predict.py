@@ -0,0 +1,86 @@
+from types import SimpleNamespace
+
+import mercantile
+import numpy as np
+import torch
+
+from abd_model.tiles import tiles_from_manifest, tile_probs_to_label
+from abd_model.tools.predict import Manifest, manifest_resume, masks_stats, probs_to_masks, scores_to_uint8
+from abd_model.tools.predict import forward, mosaic_probs
+
+
+def test_manifest_resume(tmp_path):
+    path = str(tmp_path / "manifest.csv")
+    manifest = Manifest(path)
+    manifest.add(mercantile.Tile(1, 2, 18), (42, 0.9, 0, 0, 10, 10))
+    manifest.add(mercantile.Tile(3, 4, 18), (0, 0.1, -1, -1, -1, -1))
+    manifest.close()
+
+    assert manifest_resume(path) == {mercantile.Tile(1, 2, 18), mercantile.Tile(3, 4, 18)}
+    assert list(tiles_from_manifest(path)) == [mercantile.Tile(1, 2, 18)]
+    assert list(tiles_from_manifest(path, empty=True)) == [mercantile.Tile(1, 2, 18), mercantile.Tile(3, 4, 18)]
+
+
+def test_manifest_resume_half_written(tmp_path):
+    path = str(tmp_path / "manifest.csv")
+    with open(path, "w") as fp:
+        fp.write("1,2,18,42,0.900,0,0,10,10\n3,4,18,0,0.100,-1,-1,-1,-1\n5,6,1")  # crashed while writing
+
+    assert manifest_resume(path) == {mercantile.Tile(1, 2, 18), mercantile.Tile(3, 4, 18)}
+    with open(path) as fp:
+        assert fp.read() == "1,2,18,42,0.900,0,0,10,10\n3,4,18,0,0.100,-1,-1,-1,-1\n"  # truncated, to append again
+
+    manifest = Manifest(path)
+    manifest.add(mercantile.Tile(5, 6, 18), (1, 0.6, 2, 2, 3, 3))
+    manifest.close()
+    assert manifest_resume(path) == {mercantile.Tile(1, 2, 18), mercantile.Tile(3, 4, 18), mercantile.Tile(5, 6, 18)}
+
+
+def test_scores_to_uint8_as_masks():
+    outputs = torch.tensor([-3.0, 0.2, 0.49, 0.51, 0.8, 4.0]).view(1, 1, 2, 3)
+    assert scores_to_uint8(outputs).flatten().tolist() == [0, 51, 125, 130, 204, 255]  # clipped, not squashed
+
+    outputs = torch.randn(4, 3, 8, 8, generator=torch.Generator().manual_seed(0)) * 2
+    outputs[(outputs - 0.5).abs() < 0.01] = 0.0  # away from the 0.5 quantization step
+    masks = probs_to_masks(outputs)
+    scores = np.moveaxis(scores_to_uint8(outputs).numpy(), 1, 3)
+    assert all(np.array_equal(tile_probs_to_label(score), mask) for score, mask in zip(scores, masks.numpy()))
+
+    max_score = masks_stats(outputs, masks)[:, 1]
+    assert (max_score <= 1.0).all() and (max_score >= 0.0).all()
+
+
+def pointwise_nn():
+    """A per pixel nn, without spatial context: so any window, or tile, inference is the same on a same pixel."""
+
+    torch.manual_seed(0)
+    return torch.nn.Conv2d(3, 2, kernel_size=1).eval()
+
+
+def test_mosaic_probs_as_whole_image():
+    nn, image = pointwise_nn(), torch.rand(3, 70, 90)  # windows offsets not a stride multiple, on both axes
+
+    with torch.no_grad():
+        expected = nn(image.unsqueeze(0))[0]
+        for blending in ["linear", "none"]:
+            assert torch.allclose(mosaic_probs(nn, image, 32, 8, blending, bs=3), expected, atol=1e-5)
+
+
+def test_mosaic_forward_as_per_tile():
+    nn, ts, o, K = pointwise_nn(), 32, 8, 3
+    x, y, z = 100, 200, 18
+    cover = {mercantile.Tile(x + dx, y + dy, z) for dx in range(K) for dy in range(K)} - {mercantile.Tile(x + 1, y, z)}
+    dataset = SimpleNamespace(shape_out=(2, ts, ts), cover=cover)
+    image = torch.rand(1, 3, K * ts + 2 * o, K * ts + 2 * o)  # K x K tiles mosaic, and its overlap border
+
+    for blending in ["linear", "none"]:
+        args = SimpleNamespace(mosaic=K, overlap=o, blending=blending, metatiles=False)
+        with torch.no_grad():
+            tiles, probs = forward(nn, image, torch.tensor([[x, y, z]]), args, dataset, bs=4)
+
+        assert sorted(mercantile.Tile(*tile) for tile in tiles) == sorted(cover)  # tiles out of cover skipped
+        for (tx, ty, _), prob in zip(tiles, probs):
+            row, col = o + (ty - y) * ts, o + (tx - x) * ts  # border cropped
+            with torch.no_grad():
+                expected = nn(image[:, :, row : row + ts, col : col + ts])[0]
+            assert torch.allclose(prob, expected, atol=1e-5), (tx, ty)
@@ -0,0 +1,114 @@
+import os
+import json
+import uuid
+import random
+import subprocess
+
+import pytest
+import mercantile
+import numpy as np
+from shapely import wkt
+from shapely.geometry import box
+
+from abd_model.tiles import tiles_from_dir, tile_label_from_file
+
+CONFIG = """
+[[classes]]
+  title = "Background"
+  color = "#000000"
+
+[[classes]]
+  title = "Building"
+  color = "#ff1493"
+"""
+
+
+@pytest.fixture
+def pg_table():
+    """A PostGIS features table, from ABD_TEST_PG dsn, e.g ABD_TEST_PG="dbname=test" pytest"""
+
+    psycopg2 = pytest.importorskip("psycopg2")
+    dsn = os.environ.get("ABD_TEST_PG")
+    if not dsn:
+        pytest.skip("no PostGIS database, set ABD_TEST_PG dsn to run")
+    try:
+        conn = psycopg2.connect(dsn)
+        conn.cursor().execute("SELECT PostGIS_Version()")
+    except Exception as error:
+        pytest.skip("PostGIS unavailable: {}".format(error))
+
+    table = "abd_test_{}".format(uuid.uuid4().hex[:8])
+    polygons = [  # EPSG:4326 WKT: a small building, a multi tiles one, and one with a hole
+        ("yes", "POLYGON((2.3001 48.8501, 2.3004 48.8501, 2.3004 48.8503, 2.3001 48.8503, 2.3001 48.8501))"),
+        ("garage", "POLYGON((2.3010 48.8510, 2.3060 48.8510, 2.3060 48.8540, 2.3010 48.8540, 2.3010 48.8510))"),
+        (
+            "house",
+            "POLYGON((2.3070 48.8500, 2.3090 48.8500, 2.3090 48.8520, 2.3070 48.8520, 2.3070 48.8500),"
+            " (2.3075 48.8505, 2.3085 48.8505, 2.3085 48.8515, 2.3075 48.8515, 2.3075 48.8505))",
+        ),
+    ]
+    with conn, conn.cursor() as db:
+        db.execute("CREATE TABLE {} (building text, geom geometry(Polygon, 4326))".format(table))
+        for building, polygon in polygons:
+            db.execute("INSERT INTO {} VALUES (%s, ST_GeomFromText(%s, 4326))".format(table), (building, polygon))
+
+    yield dsn, table, polygons
+
+    with conn, conn.cursor() as db:
+        db.execute("DROP TABLE {}".format(table))
+    conn.close()
+
+
+WHERE = ["", " AND building IN ('yes','house')", " AND ST_Area(geom) > 0.000001"]  # predicates kept along TILE_GEOM
+
+
+@pytest.mark.parametrize("where", WHERE)
+def test_rasterize_bulk_same_as_per_tile(tmp_path, pg_table, where):
+    dsn, table, polygons = pg_table
+
+    config = tmp_path / "config.toml"
+    config.write_text(CONFIG)
+    cover = tmp_path / "cover.csv"
+    tiles = list(mercantile.tiles(2.2995, 48.8495, 2.3095, 48.8545, 17))
+    cover.write_text("".join("{},{},{}\n".format(*tile) for tile in tiles))
+
+    sql = "SELECT geom FROM {} WHERE ST_Intersects(TILE_GEOM, geom){}".format(table, where)
+    for name, extra in [("tile", []), ("bulk", ["--bulk"])]:
+        command = ["abd", "rasterize", "--config", str(config), "--type", "Building", "--cover", str(cover)]
+        command += ["--sql", sql, "--pg", dsn, "--out", str(tmp_path / name), "--ts", "256,256", "--workers", "2"]
+        subprocess.run(command + ["--no_web_ui"] + extra, check=True, env=dict(os.environ, ABD_DEBUG="1"))
+
+    by_tile, bulk = [dict(tiles_from_dir(str(tmp_path / name), xyz_path=True)) for name in ["tile", "bulk"]]
+    assert sorted(by_tile) == sorted(bulk) == sorted(tiles)
+    for tile in tiles:
+        assert np.array_equal(tile_label_from_file(by_tile[tile]), tile_label_from_file(bulk[tile])), tile
+
+    by_tile, bulk = [(tmp_path / name / "building_cover.csv").read_text() for name in ["tile", "bulk"]]
+    assert by_tile == bulk
+    kept = {"": ["yes", "garage", "house"], WHERE[1]: ["yes", "house"], WHERE[2]: ["garage", "house"]}[where]
+    shapes = [wkt.loads(polygon) for building, polygon in polygons if building in kept]
+    counts = [sum(box(*mercantile.bounds(tile)).intersects(shape) for shape in shapes) for tile in tiles]
+    expected = ["{},{},{}  {}".format(*tile, count) for tile, count in zip(tiles, counts)]
+    assert by_tile.splitlines() == expected  # extra predicates still apply
+
+
+def test_rasterize_cover_order(tmp_path):
+    config = tmp_path / "config.toml"
+    config.write_text(CONFIG)
+    polygon = wkt.loads("POLYGON((2.3010 48.8510, 2.3060 48.8510, 2.3060 48.8540, 2.3010 48.8540, 2.3010 48.8510))")
+    features = tmp_path / "features.geojson"
+    feature = {"type": "Feature", "properties": {}, "geometry": polygon.__geo_interface__}
+    features.write_text(json.dumps({"type": "FeatureCollection", "features": [feature]}))
+
+    tiles = list(mercantile.tiles(2.2995, 48.8495, 2.3095, 48.8545, 17))
+    random.Random(42).shuffle(tiles)
+    cover = tmp_path / "cover.csv"
+    cover.write_text("".join("{},{},{}\n".format(*tile) for tile in tiles + tiles[:3]))  # shuffled, with duplicates
+
+    command = ["abd", "rasterize", "--config", str(config), "--type", "Building", "--cover", str(cover), "--no_web_ui"]
+    command += ["--geojson", str(features), "--out", str(tmp_path / "out"), "--ts", "256,256", "--workers", "2"]
+    subprocess.run(command, check=True, env=dict(os.environ, ABD_DEBUG="1"))
+
+    rows = (tmp_path / "out" / "building_cover.csv").read_text().splitlines()
+    counts = [int(box(*mercantile.bounds(tile)).intersects(polygon)) for tile in tiles]
+    assert rows == ["{},{},{}  {}".format(*tile, count) for tile, count in zip(tiles, counts)]  # input cover order kept
@@ -0,0 +1,24 @@
+import pytest
+
+from abd_model.loaders.semseg import LocalitySampler
+
+
+SHARDS = [(4, 3, 1, 0), (9, 4, 1, 2), (49, 8, 4, 3), (2, 4, 8, 1), (7, 2, 8, 0)]  # uneven, and len < replicas * bs
+
+
+@pytest.mark.parametrize("size, replicas, bs, workers", SHARDS)
+def test_locality_sampler_shards(size, replicas, bs, workers):
+    samplers = [LocalitySampler(range(size), replicas, rank, bs, workers) for rank in range(replicas)]
+    shards = [[i for batch in sampler for i in batch] for sampler in samplers]
+
+    assert sorted(i for shard in shards for i in shard) == list(range(size))  # each sample once, none duplicated
+    assert max(map(len, shards)) - min(map(len, shards)) <= 1
+    assert all(shard for shard in shards) or size < replicas  # every rank gets a batch, when there's enough samples
+    assert all(sorted(shard) == list(range(shard[0], shard[0] + len(shard))) for shard in shards if shard)  # contiguous
+
+
+def test_locality_sampler_batches():
+    sampler = LocalitySampler(range(10), num_replicas=1, rank=0, bs=3, workers=2)
+
+    assert len(sampler) == 4
+    assert list(sampler) == [[0, 1, 2], [6, 7, 8], [3, 4, 5], [9]]  # workers 0 and 1 contiguous chunks, interleaved
@@ -0,0 +1,154 @@
+import argparse
+
+import mercantile
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_bounds
+
+from abd_model.core import make_palette
+from abd_model.tiles import tiles_from_dir, tile_from_xyz, tile_image_to_file, tile_image_from_file
+from abd_model.tiles import tile_label_to_file, tile_label_from_file, tiles_stores_close
+from abd_model.tools import tile
+from abd_model.tools.tile import add_parser, main, mosaic, raster_valid_tiles, downsample, tiler_init, pyramid_worker
+
+
+def images():
+    a, b, c = [np.full((2, 2, 3), value, dtype=np.uint8) for value in (10, 20, 30)]
+    a[0, :] = 0  # a: top row nodata
+    b[:, 0] = 0  # b: left column nodata
+    c[1, 1, 0] = 0  # c: a single band nodata pixel, still a valid one
+    return [a, b, c]
+
+
+def test_mosaic_first():
+    image = mosaic(images(), nodata=0, priority="first")
+    assert image[:, :, 0].tolist() == [[30, 20], [10, 10]]
+    assert image.dtype == np.uint8
+
+
+def test_mosaic_last():
+    image = mosaic(images(), nodata=0, priority="last")
+    assert image[:, :, 0].tolist() == [[30, 30], [30, 0]]
+    assert image[1, 1].tolist() == [0, 30, 30]
+
+
+def test_mosaic_least_nodata():
+    image = mosaic(images(), nodata=0, priority="least-nodata")
+    assert image[:, :, 1].tolist() == [[30, 30], [30, 30]]
+
+
+def test_mosaic_sources_untouched():
+    sources = images()
+    copies = [source.copy() for source in sources]
+    mosaic(sources, nodata=0)
+    assert all(np.array_equal(source, copy) for source, copy in zip(sources, copies))
+    assert mosaic(sources[:1], nodata=0) is sources[0]
+
+
+def tile_args(tmp_path, raster, out, *extra):
+    parser = argparse.ArgumentParser()
+    add_parser(parser.add_subparsers(), formatter_class=argparse.HelpFormatter)
+    command = ["tile", "--rasters", raster, "--zoom", "17", "--ts", "64,64", "--out", str(tmp_path / out)]
+    return parser.parse_args(command + ["--workers", "1", "--no_web_ui"] + list(extra))
+
+
+def uint16_raster(tmp_path):
+    """A 4x6 z17 tiles aligned uint16 raster, raster nodata 0, tiled with --nodata 10:
+    row 0 raw 10 (8 bits 0, valid), rows 1,3,4,5 raw 2560 (8 bits 10, nodata), row 2 raw 0 (masked, but 8 bits valid),
+    and a single valid patch in the middle of row 5 second tile."""
+
+    x0, y0, z = 66000, 45000, 17
+    w, _, _, n = mercantile.xy_bounds(mercantile.Tile(x0, y0, z))
+    _, s, e, _ = mercantile.xy_bounds(mercantile.Tile(x0 + 3, y0 + 5, z))
+
+    data = np.full((6 * 64, 4 * 64), 2560, dtype=np.uint16)
+    data[:64], data[128:192] = 10, 0
+    data[5 * 64 + 30 : 5 * 64 + 34, 64 + 30 : 64 + 34] = 30000
+
+    path = str(tmp_path / "raster.tif")
+    profile = dict(driver="GTiff", width=4 * 64, height=6 * 64, count=1, dtype="uint16", crs="EPSG:3857", nodata=0)
+    with rasterio.open(path, "w", transform=from_bounds(w, s, e, n, 4 * 64, 6 * 64), **profile) as raster:
+        raster.write(data, 1)
+
+    tiles = [mercantile.Tile(x0 + dx, y0 + dy, z) for dy in range(6) for dx in range(4)]
+    expected = [tile for tile in tiles if tile.y in (y0, y0 + 2)] + [mercantile.Tile(x0 + 1, y0 + 5, z)]
+    return path, tiles, expected
+
+
+def test_raster_valid_tiles_screen_uint16(tmp_path, monkeypatch):
+    path, tiles, expected = uint16_raster(tmp_path)
+
+    with rasterio.open(path) as raster:
+        valid = raster_valid_tiles(raster, tiles, [1], 10)
+    assert 0 < valid.sum() < len(tiles)  # some tiles are screened, none of the expected ones
+    assert all(keep for tile, keep in zip(tiles, valid.tolist()) if tile in expected)
+
+    main(tile_args(tmp_path, path, "screened", "--nodata", "10", "--keep_borders"))
+    monkeypatch.setattr(tile, "raster_valid_tiles", lambda *args, **kwargs: None)
+    main(tile_args(tmp_path, path, "unscreened", "--nodata", "10", "--keep_borders"))
+
+    screened, unscreened = [sorted(tiles_from_dir(str(tmp_path / out))) for out in ("screened", "unscreened")]
+    assert screened == unscreened == sorted(expected)
+
+
+def test_downsample():
+    image = np.array([[10, 20, 0, 0], [30, 41, 0, 0], [0, 0, 5, 6], [0, 100, 7, 8]], dtype=np.uint8).reshape(4, 4, 1)
+
+    assert downsample(image, nodata=0)[:, :, 0].tolist() == [[25, 0], [100, 6]]  # nodata pixels not averaged
+    assert downsample(image, nodata=0, label=True)[:, :, 0].tolist() == [[10, 0], [0, 5]]
+    assert downsample(image, nodata=5)[1, 1, 0] == 7  # another nodata value
+
+
+def children_images(tile):
+    """Parent tile 4x4 children: a top left uniform one, a top right with a nodata pixel, a bottom right all nodata."""
+
+    x, y, z = 2 * tile.x, 2 * tile.y, tile.z + 1
+    ul, ur, lr = mercantile.Tile(x, y, z), mercantile.Tile(x + 1, y, z), mercantile.Tile(x + 1, y + 1, z)
+    images = {ul: np.full((4, 4, 1), 40, dtype=np.uint8), ur: np.arange(16, dtype=np.uint8).reshape(4, 4, 1) * 10}
+    images[lr] = np.zeros((4, 4, 1), dtype=np.uint8)
+    return images  # bottom left missing
+
+
+@pytest.mark.parametrize("store", [False, True])
+def test_pyramid_worker(tmp_path, store):
+    out = "mbtiles://{}".format(tmp_path / "tiles.mbtiles") if store else str(tmp_path / "tiles")
+    parent = mercantile.Tile(10, 20, 17)
+    images = children_images(parent)
+    for child, image in images.items():
+        tile_image_to_file(out, child, image)
+    tiles_stores_close()
+
+    args = tile_args(tmp_path, "unused.tif", "unused", "--keep_borders")
+    args.out = out
+    tiler_init(args, {}, 4, 4, None, "png")
+    assert pyramid_worker([parent, mercantile.Tile(0, 0, 17)]) == ([parent], 2)  # childless parent: not written
+
+    mosaic = np.zeros((8, 8, 1), dtype=np.uint8)  # missing child as nodata
+    for child, image in images.items():
+        row, col = (child.y - 2 * parent.y) * 4, (child.x - 2 * parent.x) * 4
+        mosaic[row : row + 4, col : col + 4] = image
+    blocks = mosaic.reshape(4, 2, 4, 2).astype(np.float64)
+    valid = (blocks != 0).sum(axis=(1, 3))
+    expected = np.where(valid > 0, np.round(blocks.sum(axis=(1, 3)) / np.maximum(valid, 1)), 0)
+
+    image = tile_image_from_file(tile_from_xyz(out, parent.x, parent.y, parent.z)[1])
+    assert image[:, :, 0].tolist() == expected.tolist()
+    assert image[2:, :, 0].tolist() == [[0, 0, 0, 0], [0, 0, 0, 0]]  # missing and nodata children
+    assert image[0, 2:, 0].tolist() == [33, 45]  # 0, 10, 40, 50 block: its 0 pixel is nodata, not averaged
+    tiles_stores_close()
+
+
+def test_pyramid_worker_label(tmp_path):
+    palette, transparency = make_palette(["#000000", "#ff1493", "#00ff00"])
+    parent = mercantile.Tile(10, 20, 17)
+    label = np.array([[1, 2, 1, 2], [2, 2, 2, 2], [0, 0, 1, 1], [0, 0, 1, 1]], dtype=np.uint8)
+    for child in [mercantile.Tile(20, 40, 18), mercantile.Tile(21, 40, 18)]:  # top children only
+        tile_label_to_file(str(tmp_path / "labels"), child, palette, transparency, label)
+
+    args = tile_args(tmp_path, "unused.tif", "labels", "--label")
+    tiler_init(args, {}, 4, 4, palette, "png")
+    assert pyramid_worker([parent]) == ([parent], 1)
+
+    image = tile_label_from_file(tile_from_xyz(str(tmp_path / "labels"), parent.x, parent.y, parent.z)[1])
+    assert image.tolist() == [[1, 1, 1, 1], [0, 1, 0, 1], [0, 0, 0, 0], [0, 0, 0, 0]]  # nearest, never averaged classes
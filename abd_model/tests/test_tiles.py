@@ -0,0 +1,166 @@
+import os
+import time
+
+import mercantile
+import numpy as np
+
+from abd_model.core import make_palette
+from abd_model.loaders.semseg import stack_channel
+from abd_model.tiles import (
+    TileIndex,
+    TILES_INDEX,
+    tiles_scan,
+    tiles_store,
+    tiles_stores_close,
+    tiles_from_dir,
+    tiles_side_path,
+    tile_from_xyz,
+    tile_image_to_file,
+    tile_image_from_file,
+    tile_label_to_file,
+    tile_label_from_file,
+)
+
+
+def test_tile_index_keys_round_trip():
+    tiles = [mercantile.Tile(0, 0, 0), mercantile.Tile(3, 5, 3), mercantile.Tile(2**29 - 1, 2**29 - 1, 29)]
+    tiles += [mercantile.Tile(x, y, 18) for x, y in [(132750, 90184), (132751, 90184), (132750, 90185)]]
+
+    index = TileIndex(tiles)
+    assert list(index) == sorted(tiles, key=lambda tile: (tile.z, tile.x, tile.y))
+
+    x, y, z = np.array(tiles, dtype=np.int64).T
+    keys = TileIndex.encode(x, y, z)
+    assert len(set(keys.tolist())) == len(tiles)
+    assert np.array_equal(np.sort(keys), index.keys)
+    assert np.array_equal(index.keys[index.lookup(x, y, z)], keys)
+
+
+def test_tile_index_lookup():
+    tiles = [mercantile.Tile(x, y, 10) for x in range(4) for y in range(4)]
+    index = TileIndex([(tile, "{}/{}/{}.png".format(tile.z, tile.x, tile.y)) for tile in tiles + tiles[:2]])
+
+    assert len(index) == len(tiles)
+    assert mercantile.Tile(1, 2, 10) in index
+    assert mercantile.Tile(1, 2, 11) not in index
+    assert mercantile.Tile(4, 0, 10) not in index
+    assert index.contains([0, 3, 4, -1], [0, 3, 0, 0], 10).tolist() == [True, True, False, False]
+    assert index.path(mercantile.Tile(1, 1, 10), 1, 1) == "10/2/2.png"
+    assert index.path(mercantile.Tile(3, 3, 10), 1, 0) is None
+
+    neighboured = index.select(index.neighboured())
+    assert list(neighboured) == [mercantile.Tile(x, y, 10) for x in (1, 2) for y in (1, 2)]
+    assert [path for _, path in neighboured.items()] == ["10/1/1.png", "10/1/2.png", "10/2/1.png", "10/2/2.png"]
+
+
+def test_tile_index_empty():
+    index = TileIndex([])
+
+    assert len(index) == 0
+    assert mercantile.Tile(0, 0, 0) not in index
+    assert index.lookup([0, 1], [0, 1], [1, 1]).tolist() == [-1, -1]
+
+
+def test_mbtiles_store_read_write(tmp_path):
+    root = "mbtiles://{}".format(tmp_path / "images.mbtiles")
+    images = {mercantile.Tile(x, y, 18): np.full((8, 8, 3), x + y, dtype=np.uint8) for x, y in [(1, 2), (3, 4)]}
+    for tile, image in images.items():
+        tile_image_to_file(root, tile, image, ext="png")
+
+    assert tiles_store(root) is tiles_store(root)  # opened once per process
+    assert tile_from_xyz(root, 5, 6, 18) is None
+    assert sorted(tile for tile, _ in tiles_from_dir(root, xyz_path=True)) == sorted(images)
+    for tile, path in tiles_from_dir(root, xyz_path=True):
+        assert np.array_equal(tile_image_from_file(path), images[tile])
+
+    tiles_stores_close()  # committed, and then readable from another connection
+    assert sorted(tiles_from_dir(root)) == sorted(images)
+    tiles_stores_close()
+
+
+def test_mbtiles_store_labels_append(tmp_path):
+    palette, transparency = make_palette(["#000000", "#ff1493"])
+    tile = mercantile.Tile(1, 2, 18)
+    row, column = np.zeros((8, 8), dtype=np.uint8), np.zeros((8, 8), dtype=np.uint8)
+    row[0, :], column[:, 0] = 1, 1
+
+    for root in [str(tmp_path / "labels"), "mbtiles://{}".format(tmp_path / "labels.mbtiles")]:
+        tile_label_to_file(root, tile, palette, transparency, row, append=True)
+        tile_label_to_file(root, tile, palette, transparency, column, append=True)
+        assert np.array_equal(tile_label_from_file(tile_from_xyz(root, 1, 2, 18)[1]), np.maximum(row, column))
+
+    tiles_stores_close()
+
+
+def test_tiles_side_path(tmp_path):
+    assert tiles_side_path(str(tmp_path / "masks"), "log") == str(tmp_path / "masks" / "log")
+
+    a, b = ["mbtiles://{}".format(tmp_path / name) for name in ["a.mbtiles", "b.mbtiles"]]
+    assert tiles_side_path(a, "manifest.csv") == str(tmp_path / "a.manifest.csv")
+    assert tiles_side_path(a, "manifest.csv") != tiles_side_path(b, "manifest.csv")
+
+    tiles_stores_close()
+
+
+def test_tiles_scan_index_revalidation(tmp_path):
+    def touch(x, y, z=18, age=3600):
+        os.makedirs(str(tmp_path / str(z) / str(x)), exist_ok=True)
+        (tmp_path / str(z) / str(x) / "{}.png".format(y)).write_bytes(b"")
+        past = time.time() - age
+        os.utime(str(tmp_path / str(z) / str(x)), (past, past))  # old enough, for the index to trust its mtime
+
+    def scanned():
+        xyz, exts = tiles_scan(str(tmp_path))
+        assert set(exts.tolist()) <= {"png"}
+        return sorted(mercantile.Tile(x, y, z) for x, y, z in xyz.tolist())
+
+    for x, y in [(1, 1), (1, 2), (2, 1)]:
+        touch(x, y)
+    assert scanned() == [mercantile.Tile(1, 1, 18), mercantile.Tile(1, 2, 18), mercantile.Tile(2, 1, 18)]
+    assert os.path.isfile(str(tmp_path / TILES_INDEX))
+
+    touch(2, 5, age=7200)  # added, with an x dir mtime set back to another old one: changed, so rescanned
+    os.remove(str(tmp_path / "18" / "1" / "2.png"))  # removed, x dir mtime now a fresh one
+    touch(3, 3)  # a new x dir
+    expected = [mercantile.Tile(1, 1, 18), mercantile.Tile(2, 1, 18), mercantile.Tile(2, 5, 18), mercantile.Tile(3, 3, 18)]
+    assert scanned() == expected
+
+    with np.load(str(tmp_path / TILES_INDEX)) as index:  # stale index rebuilt
+        assert index["dirs"].tolist() == [[18, 1], [18, 2], [18, 3]]
+        assert index["counts"].tolist() == [1, 2, 1]
+        assert index["mtimes"][0] == -1  # too recent a mtime is never trusted
+    assert scanned() == expected
+
+    os.remove(str(tmp_path / "18" / "1" / "1.png"))
+    os.rmdir(str(tmp_path / "18" / "1"))
+    assert scanned() == expected[1:]
+
+
+def test_tile_image_from_file_bands(tmp_path):
+    rgb = np.stack([np.full((8, 8), value, dtype=np.uint8) for value in (10, 20, 30)], axis=2)
+    tile_image_to_file(str(tmp_path), mercantile.Tile(1, 2, 18), rgb, ext="png")
+    tile_image_to_file(str(tmp_path), mercantile.Tile(1, 3, 18), np.concatenate([rgb, rgb[:, :, :1] + 30], axis=2))
+    png, tiff = [str(tmp_path / "18" / "1" / name) for name in ("2.png", "3.tiff")]
+
+    for path, codec in [(png, "pil"), (png, "cv2"), (tiff, None)]:  # bands as selected, in order, on every codec
+        assert tile_image_from_file(path, codec=codec)[0, 0].tolist()[:3] == [10, 20, 30]
+        assert tile_image_from_file(path, bands=[3, 1], codec=codec)[0, 0].tolist() == [30, 10]
+        assert tile_image_from_file(path, bands=[2], codec=codec).shape == (8, 8, 1)
+    assert tile_image_from_file(tiff, bands=[4, 2])[0, 0].tolist() == [40, 20]
+
+
+def test_tile_image_from_file_out(tmp_path):
+    tile_image_to_file(str(tmp_path), mercantile.Tile(1, 2, 18), np.full((8, 8, 4), 1000, dtype=np.uint16))
+    tile_image_to_file(str(tmp_path), mercantile.Tile(1, 3, 18), np.full((8, 8, 3), 7, dtype=np.uint8), ext="png")
+    tiff, png = [str(tmp_path / "18" / "1" / name) for name in ("2.tiff", "3.png")]
+
+    buffer = np.zeros((8, 8, 5), dtype=np.uint8)
+    image = tile_image_from_file(png, bands=[1, 2], out=buffer[:, :, 1:3])  # decoded in place, in a channels view
+    assert np.shares_memory(image, buffer) and buffer[0, 0].tolist() == [0, 7, 7, 0, 0]
+
+    image = tile_image_from_file(tiff, bands=[2, 4], out=buffer[:, :, 3:5])  # a wider dtype: out left untouched
+    assert not np.shares_memory(image, buffer) and buffer[0, 0].tolist() == [0, 7, 7, 0, 0]
+    assert image.dtype == np.uint16 and image[0, 0].tolist() == [1000, 1000]  # not wrapped
+
+    stacked = stack_channel(buffer, image, 3, 5)  # the caller upcasts the buffer
+    assert stacked.dtype == np.uint16 and stacked[0, 0].tolist() == [0, 7, 7, 1000, 1000]